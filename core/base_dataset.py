@@ -4,6 +4,8 @@ from PIL import Image
 import os
 import numpy as np
 
+from core.file_index import FileIndex
+
 IMG_EXTENSIONS = [
     '.jpg', '.JPG', '.jpeg', '.JPEG',
     '.png', '.PNG', '.ppm', '.PPM', '.bmp', '.BMP',
@@ -16,13 +18,8 @@ def make_dataset(dir):
     if os.path.isfile(dir):
         images = [i for i in np.genfromtxt(dir, dtype=np.str, encoding='utf-8')]
     else:
-        images = []
-        assert os.path.isdir(dir), '%s is not a valid directory' % dir
-        for root, _, fnames in sorted(os.walk(dir)):
-            for fname in sorted(fnames):
-                if is_image_file(fname):
-                    path = os.path.join(root, fname)
-                    images.append(path)
+        ''' the directory tree is walked once and kept in an index that is refreshed incrementally '''
+        images = FileIndex(dir, is_image_file).paths
 
     return images
 
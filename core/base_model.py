@@ -38,7 +38,10 @@ class BaseModel():
     def train(self):
         while self.epoch <= self.opt['train']['n_epoch'] and self.iter <= self.opt['train']['n_iter']:
             self.epoch += 1
-            if self.opt['distributed']:
+            if hasattr(self.phase_loader.dataset, 'set_epoch'):
+                ''' streaming datasets shuffle their shards themselves and take the epoch instead of the sampler '''
+                self.phase_loader.dataset.set_epoch(self.epoch)
+            elif self.opt['distributed']:
                 ''' sets the epoch for this sampler. When :attr:`shuffle=True`, this ensures all replicas use a different random ordering for each epoch '''
                 self.phase_loader.sampler.set_epoch(self.epoch) 
 
@@ -131,6 +134,7 @@ class BaseModel():
             state['schedulers'].append(s.state_dict())
         for o in self.optimizers:
             state['optimizers'].append(o.state_dict())
+        state.update(self.get_training_state())
         save_filename = '{}.state'.format(self.epoch)
         save_path = os.path.join(self.opt['path']['checkpoint'], save_filename)
         torch.save(state, save_path)
@@ -162,6 +166,15 @@ class BaseModel():
 
         self.epoch = resume_state['epoch']
         self.iter = resume_state['iter']
+        self.set_training_state(resume_state)
+
+    def get_training_state(self):
+        ''' extra entries of the saved training state, can rewrite in inherited class '''
+        return {}
+
+    def set_training_state(self, state):
+        ''' restore the extra entries of get_training_state from a resumed training state '''
+        pass
 
     def load_everything(self):
         pass 
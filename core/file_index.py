@@ -0,0 +1,136 @@
+"""
+persistent index of the images below a directory, so that make_dataset does not walk the whole tree on every launch.
+the index keeps the mtime, the image files and the subdirectories of every directory. on load only the directories whose
+mtime changed (files were added, removed or renamed in them) are listed again, which needs one stat per directory.
+image sizes and content hashes are kept for every file when the index was built with them.
+indexes are stored in INDEX_DIR (PALETTE_INDEX_DIR, ~/.cache/palette/file_index by default), not in the dataset directory,
+which may be a read-only mount.
+"""
+import argparse
+import hashlib
+import os
+import pickle
+import warnings
+from PIL import Image
+
+import core.util as Util
+
+INDEX_DIR = os.environ.get('PALETTE_INDEX_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'palette', 'file_index'))
+INDEX_VERSION = 1
+
+def default_index_path(root):
+    ''' one index per dataset directory, named after the directory and a hash of its absolute path '''
+    root = os.path.abspath(root)
+    key = hashlib.blake2b(root.encode('utf-8'), digest_size=8).hexdigest()
+    return os.path.join(INDEX_DIR, '{}_{}.pkl'.format(os.path.basename(root) or 'root', key))
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FileIndex():
+    """
+    index of the files below root accepted by is_image_file, stored in default_index_path(root) (or index_path).
+    sizes / hashes enable the (width, height) and blake2b records, None keeps the setting of an existing index.
+    under DDP GPU 0 builds or refreshes the index first and the other GPUs then load it.
+    """
+    def __init__(self, root, is_image_file, index_path=None, sizes=None, hashes=None):
+        self.root = root
+        self.is_image_file = is_image_file
+        self.index_path = index_path or default_index_path(root)
+        with Util.rank_zero_first():
+            index = self.load()
+            self.with_sizes = index.get('sizes', False) if sizes is None else sizes
+            self.with_hashes = index.get('hashes', False) if hashes is None else hashes
+            options_changed = (self.with_sizes, self.with_hashes) != (index.get('sizes'), index.get('hashes'))
+            self.dirs, changed = self.refresh(index.get('dirs', {}) if not options_changed else {})
+            if changed or options_changed:
+                self.save()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return {}
+        return index if index.get('version') == INDEX_VERSION else {}
+
+    def save(self):
+        ''' written to a temporary file first, processes that load the index concurrently see the old or the new one '''
+        tmp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        index = {'version': INDEX_VERSION, 'sizes': self.with_sizes, 'hashes': self.with_hashes, 'dirs': self.dirs}
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            warnings.warn('File index {} could not be written: {}'.format(self.index_path, e))
+
+    def list_dir(self, path, mtime, old):
+        ''' one directory like os.walk sees it, sizes and hashes of files already in old are reused '''
+        files, subdirs = [], []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    # os.walk lists symlinked directories but does not descend into them
+                    if not entry.is_symlink():
+                        subdirs.append(entry.name)
+                elif self.is_image_file(entry.name):
+                    files.append(entry.name)
+        record = {'mtime': mtime, 'files': sorted(files), 'subdirs': sorted(subdirs), 'sizes': {}, 'hashes': {}}
+        old = old or {'sizes': {}, 'hashes': {}}
+        for name in record['files']:
+            if self.with_sizes:
+                record['sizes'][name] = old['sizes'].get(name) or Image.open(os.path.join(path, name)).size
+            if self.with_hashes:
+                record['hashes'][name] = old['hashes'].get(name) or file_hash(os.path.join(path, name))
+        return record
+
+    def refresh(self, old_dirs):
+        ''' records of all directories below root, only the ones with a new mtime are listed again '''
+        assert os.path.isdir(self.root), '%s is not a valid directory' % self.root
+        dirs, changed, stack = {}, False, ['']
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(self.root, rel)
+            mtime = os.stat(path).st_mtime_ns
+            record = old_dirs.get(rel)
+            if record is None or record['mtime'] != mtime:
+                new_record = self.list_dir(path, mtime, record)
+                changed = changed or record is None or (new_record['files'], new_record['subdirs']) != (record['files'], record['subdirs'])
+                record = new_record
+            dirs[rel] = record
+            stack.extend(os.path.join(rel, name) for name in record['subdirs'])
+        return dirs, changed or len(dirs) != len(old_dirs)
+
+    @property
+    def paths(self):
+        ''' image paths in the order of sorted(os.walk(root)) with sorted file names '''
+        roots = sorted((os.path.join(self.root, rel) if rel else self.root, rel) for rel in self.dirs)
+        return [os.path.join(path, name) for path, rel in roots for name in self.dirs[rel]['files']]
+
+    def size(self, path):
+        ''' (width, height) of an indexed image, None if the index has no sizes '''
+        rel, name = os.path.split(os.path.relpath(path, self.root))
+        return self.dirs[rel]['sizes'].get(name)
+
+    def hash(self, path):
+        rel, name = os.path.split(os.path.relpath(path, self.root))
+        return self.dirs[rel]['hashes'].get(name)
+
+
+if __name__ == '__main__':
+    ''' builds or refreshes the index of a directory ahead of training, e.g. with sizes and hashes '''
+    from data.dataset import is_image_file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', type=str)
+    parser.add_argument('--sizes', action='store_true')
+    parser.add_argument('--hashes', action='store_true')
+    args = parser.parse_args()
+    index = FileIndex(args.root, is_image_file, sizes=args.sizes, hashes=args.hashes)
+    print('Indexed {} images in {} directories of {} into {}'.format(len(index.paths), len(index.dirs), args.root, index.index_path))
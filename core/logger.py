@@ -3,7 +3,7 @@ from PIL import Image
 import importlib
 from datetime import datetime
 import logging
-import pandas as pd
+import torch
 
 import core.util as Util
 
@@ -145,24 +145,28 @@ class VisualWriter():
 
 class LogTracker:
     """
-    record training numerical indicators.
+    record training numerical indicators. tensor values are summed on their own device, 
+    they are only copied to the host when the averages are read.
     """
     def __init__(self, *keys, phase='train'):
         self.phase = phase
-        self._data = pd.DataFrame(index=keys, columns=['total', 'counts', 'average'])
+        self.keys = keys
         self.reset()
 
     def reset(self):
-        for col in self._data.columns:
-            self._data[col].values[:] = 0
+        self._total = {key: 0. for key in self.keys}
+        self._counts = {key: 0 for key in self.keys}
 
     def update(self, key, value, n=1):
-        self._data.total[key] += value * n
-        self._data.counts[key] += n
-        self._data.average[key] = self._data.total[key] / self._data.counts[key]
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+        self._total[key] = self._total[key] + value * n
+        self._counts[key] += n
 
     def avg(self, key):
-        return self._data.average[key]
+        if self._counts[key] == 0:
+            return 0.
+        return float(self._total[key] / self._counts[key])
 
     def result(self):
-        return {'{}/{}'.format(self.phase, k):v for k, v in dict(self._data.average).items()}
+        return {'{}/{}'.format(self.phase, k):self.avg(k) for k in self.keys}
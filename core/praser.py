@@ -94,13 +94,17 @@ def dict2str(opt, indent_l=1):
             msg += ' ' * (indent_l * 2) + k + ': ' + str(v) + '\n'
     return msg
 
-def parse(args):
+def load_config(path):
+    """ read a json configure file, // starts a comment """
     json_str = ''
-    with open(args.config, 'r') as f:
+    with open(path, 'r') as f:
         for line in f:
             line = line.split('//')[0] + '\n'
             json_str += line
-    opt = json.loads(json_str, object_pairs_hook=OrderedDict)
+    return json.loads(json_str, object_pairs_hook=OrderedDict)
+
+def parse(args):
+    opt = load_config(args.config)
 
     ''' replace the config context using args '''
     opt['phase'] = args.phase
@@ -108,6 +112,10 @@ def parse(args):
         opt['gpu_ids'] = [int(id) for id in args.gpu_ids.split(',')]
     if args.batch is not None:
         opt['datasets'][opt['phase']]['dataloader']['args']['batch_size'] = args.batch
+    for key in ['sample_mode', 'sample_steps']:
+        if getattr(args, key, None) is not None:
+            for network_opt in opt['model']['which_networks']:
+                network_opt['args'].setdefault('sample_config', {})[key] = getattr(args, key)
  
     ''' set cuda environment '''
     if len(opt['gpu_ids']) > 1:
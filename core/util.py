@@ -1,7 +1,9 @@
+import contextlib
 import random
 import numpy as np
 import math
 import torch
+import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torchvision.utils import make_grid
 
@@ -61,6 +63,30 @@ def set_gpu(args, distributed=False, rank=0):
 	else:
 		return args.cuda()
 		
+@contextlib.contextmanager
+def rank_zero_first(enabled=True):
+	"""
+	GPU 0 runs the block first (e.g. to build a file on disk), the other GPUs run it once GPU 0 is done.
+	if the block raises on GPU 0, the other GPUs raise a RuntimeError instead of waiting for it forever.
+	"""
+	if not (enabled and dist.is_available() and dist.is_initialized()):
+		yield
+		return
+	if dist.get_rank() != 0:
+		''' waits for GPU 0, which sends its error or None '''
+		error = [None]
+		dist.broadcast_object_list(error, src=0)
+		if error[0] is not None:
+			raise RuntimeError(f'GPU 0 failed in rank_zero_first: {error[0]}')
+		yield
+		return
+	try:
+		yield
+	except BaseException as e:
+		dist.broadcast_object_list([repr(e)], src=0)
+		raise
+	dist.broadcast_object_list([None], src=0)
+
 def set_device(args, distributed=False, rank=0):
 	""" set parameter to gpu or cpu """
 	if torch.cuda.is_available():
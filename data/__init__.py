@@ -3,7 +3,7 @@ import numpy as np
 
 from torch.utils.data.distributed import DistributedSampler
 from torch import Generator, randperm
-from torch.utils.data import DataLoader, Subset
+from torch.utils.data import DataLoader, Subset, IterableDataset
 
 import core.util as Util
 from core.praser import init_obj
@@ -19,7 +19,11 @@ def define_dataloader(logger, opt):
 
     '''create datasampler'''
     data_sampler = None
-    if opt['distributed']:
+    if isinstance(phase_dataset, IterableDataset):
+        ''' iterable datasets shuffle and split their shards over GPUs and workers themselves '''
+        dataloader_args.update({'shuffle':False})
+        phase_dataset.set_loader(batch_size=dataloader_args.get('batch_size', 1), num_workers=dataloader_args.get('num_workers', 0))
+    elif opt['distributed']:
         data_sampler = DistributedSampler(phase_dataset, shuffle=dataloader_args.get('shuffle', False), num_replicas=opt['world_size'], rank=opt['global_rank'])
         dataloader_args.update({'shuffle':False}) # sampler option is mutually exclusive with shuffle 
     
@@ -37,6 +41,10 @@ def define_dataloader(logger, opt):
 def define_dataset(logger, opt):
     ''' loading Dataset() class from given file's name '''
     dataset_opt = opt['datasets'][opt['phase']]['which_dataset']
+    ''' a mask bank is generated with the seed of the run, a random seed (-1) keeps the seed of the mask_bank config '''
+    mask_bank_opt = (dataset_opt.get('args') or {}).get('mask_config', {}).get('mask_bank')
+    if mask_bank_opt is not None and opt['seed'] >= 0:
+        mask_bank_opt.setdefault('seed', opt['seed'])
     phase_dataset = init_obj(dataset_opt, logger, default_file_name='data.dataset', init_type='Dataset')
     val_dataset = None
 
@@ -52,8 +60,11 @@ def define_dataset(logger, opt):
     dataloder_opt = opt['datasets'][opt['phase']]['dataloader']
     valid_split = dataloder_opt.get('validation_split', 0)    
     
-    ''' divide validation dataset, valid_split==0 when phase is test or validation_split is 0. '''
-    if valid_split > 0.0 or 'debug' in opt['name']: 
+    ''' divide validation dataset, valid_split==0 when phase is test or validation_split is 0. streaming datasets can not be split. '''
+    if isinstance(phase_dataset, IterableDataset):
+        if valid_split > 0.0:
+            logger.warning('Validation split is not supported by the streaming dataset {}, Skip it.'.format(phase_dataset.__class__.__name__))
+    elif valid_split > 0.0 or 'debug' in opt['name']: 
         if isinstance(valid_split, int):
             assert valid_split < data_len, "Validation set size is configured to be larger than entire dataset."
             valid_len = valid_split
@@ -67,6 +78,13 @@ def define_dataset(logger, opt):
         logger.info('Dataset for {} have {} samples.'.format('val', valid_len))   
     return phase_dataset, val_dataset
 
+def define_batch_stage(dataloader):
+    ''' per-batch work a dataset leaves for the device after collation (batch_stage attribute), None if there is none '''
+    dataset = dataloader.dataset if dataloader is not None else None
+    while isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    return getattr(dataset, 'batch_stage', None)
+
 def subset_split(dataset, lengths, generator):
     """
     split a dataset into non-overlapping new datasets of given lengths. main code is from random_split function in pytorch
@@ -0,0 +1,68 @@
+import os
+import json
+from multiprocessing import Pool
+import numpy as np
+from PIL import Image
+
+from .util.mask import white_pixels_mask, red_pixels_mask
+
+''' masks that depend on the image only, they are computed once when the cache is built '''
+CACHED_MASK_MODES = {
+    'white_pixels': white_pixels_mask,
+    'red_pixels': red_pixels_mask,
+}
+
+def decode_image(path, image_size, mask_mode=None):
+    ''' uint8 [h, w, 3] image resized like InpaintDataset does, and its [h, w, 1] mask for cached mask modes '''
+    img = Image.open(str(path)).convert('RGB')
+    # bilinear with antialias, as transforms.Resize does for PIL images
+    img = np.asarray(img.resize((image_size[1], image_size[0]), Image.BILINEAR))
+    mask = CACHED_MASK_MODES[mask_mode](img) if mask_mode is not None else None
+    return img, mask
+
+def _decode(args):
+    return decode_image(*args)
+
+def build_image_cache(paths, cache_dir, image_size, mask_mode=None, num_workers=8):
+    """
+    decode and resize every image once into cache_dir/images.npy, a uint8 [n, h, w, 3] array that is read with mmap.
+    for the white_pixels and red_pixels mask modes the masks are stored as well, in masks.npy ([n, h, w, 1]).
+    index.json records the paths, the image size and the mask mode.
+    """
+    if mask_mode is not None and mask_mode not in CACHED_MASK_MODES:
+        raise NotImplementedError('Mask mode {} can not be cached.'.format(mask_mode))
+    os.makedirs(cache_dir, exist_ok=True)
+    h, w = image_size
+    images = np.lib.format.open_memmap(os.path.join(cache_dir, 'images.npy'), mode='w+', dtype=np.uint8, shape=(len(paths), h, w, 3))
+    masks = None
+    if mask_mode is not None:
+        masks = np.lib.format.open_memmap(os.path.join(cache_dir, 'masks.npy'), mode='w+', dtype=np.uint8, shape=(len(paths), h, w, 1))
+
+    with Pool(num_workers) as pool:
+        for idx, (img, mask) in enumerate(pool.imap(_decode, [(path, image_size, mask_mode) for path in paths], chunksize=16)):
+            images[idx] = img
+            if masks is not None:
+                masks[idx] = mask
+    images.flush()
+    if masks is not None:
+        masks.flush()
+
+    with open(os.path.join(cache_dir, 'index.json'), 'w') as f:
+        json.dump({'paths': [str(path) for path in paths], 'image_size': list(image_size), 'mask_mode': mask_mode}, f)
+
+
+class ImageCache():
+    ''' read side of build_image_cache, images and masks are copy-on-write memory maps, so indexing them does not copy '''
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.paths = index['paths']
+        self.image_size = index['image_size']
+        self.mask_mode = index['mask_mode']
+        self.images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode='c')
+        self.masks = None
+        if self.mask_mode is not None:
+            self.masks = np.load(os.path.join(cache_dir, 'masks.npy'), mmap_mode='c')
+
+    def __len__(self):
+        return len(self.paths)
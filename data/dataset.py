@@ -1,11 +1,22 @@
 import torch.utils.data as data
 from torchvision import transforms
 from PIL import Image
+import io
+import math
 import os
+import random
 import torch
+import torch.distributed as dist
 import numpy as np
+from functools import partial
 
-from .util.mask import (bbox2mask, brush_stroke_mask, get_irregular_mask, random_bbox, random_cropping_bbox, create_mask_from_image, get_mask_from_image_white_pixels, get_mask_from_image_red_pixels)
+from core.file_index import FileIndex
+
+from .util.mask import (bbox2mask, brush_stroke_mask, get_irregular_mask, random_bbox, random_cropping_bbox, create_mask_from_image)
+from .util.mask_bank import MaskBank
+from .util.batch_mask import INPAINT_MASK_MODES, UNCROP_MASK_MODES, batch_inpaint_masks, batch_uncrop_masks, masks_like, pack_mask_bits, unpack_mask_bits
+from .cache import ImageCache, CACHED_MASK_MODES
+from .shards import load_shard_index, iter_shard
 
 IMG_EXTENSIONS = [
     '.jpg', '.JPG', '.jpeg', '.JPEG',
@@ -36,13 +47,8 @@ def make_dataset(dir):
         with open(dir, 'r', encoding='utf-8') as f:
             images = [line.strip() for line in f.readlines() if line.strip()]
     else:
-        images = []
-        assert os.path.isdir(dir), '%s is not a valid directory' % dir
-        for root, _, fnames in sorted(os.walk(dir)):
-            for fname in sorted(fnames):
-                if is_image_file(fname):
-                    path = os.path.join(root, fname)
-                    images.append(path)
+        ''' the directory tree is walked once and kept in an index that is refreshed incrementally '''
+        images = FileIndex(dir, is_image_file).paths
 
     return images
 
@@ -52,15 +58,50 @@ def pil_loader(path):
         
     return Image.open(path).convert('RGB')
 
+def stage_masked_batch(batch, make_mask=None):
+    """
+    second half of InpaintDataset / UncroppingDataset.__getitem__, runs on the collated batch once it is on the device.
+    uint8 images (cached or lean samples) are normalised here, bit-packed masks (lean samples) are unpacked and batches
+    without a mask get it from make_mask(gt_image).
+    """
+    if 'mask_bits' in batch:
+        batch['mask'] = unpack_mask_bits(batch.pop('mask_bits'), batch['gt_image'].shape[-1])
+    if 'mask' not in batch:
+        batch['mask'] = make_mask(batch['gt_image'])
+    img = batch['gt_image']
+    if img.dtype == torch.uint8:
+        img = img.float().div(255.).sub(0.5).div(0.5)
+    mask = batch['mask']
+    batch['gt_image'] = img
+    batch['cond_image'] = img*(1. - mask) + mask*torch.randn_like(img)
+    batch['mask_image'] = img*(1. - mask) + mask
+    return batch
+
 class InpaintDataset(data.Dataset):
-    def __init__(self, data_root, mask_config={}, data_len=-1, image_size=[512, 512], loader=pil_loader):
+    def __init__(self, data_root, mask_config={}, data_len=-1, image_size=[512, 512], loader=pil_loader, resize=True, cache_dir=None, lean=False):
+        """
+        resize=False keeps every image at its own size (for tiled sampling), which needs batch_size 1 or equally sized images.
+        cache_dir points to a cache of data_root built by preprocess/build_inpaint_cache.py, samples are then uint8 views of it
+        and batch_stage does the normalisation on the device.
+        mask_config on_device draws the masks of INPAINT_MASK_MODES for the whole batch in batch_stage instead of per sample.
+        lean samples are a uint8 image and a bit-packed mask, batch_stage normalises and composes them on the device.
+        """
         imgs = make_dataset(data_root)
         if data_len > 0:
             self.imgs = imgs[:int(data_len)]
         else:
             self.imgs = imgs
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = ImageCache(cache_dir)
+            assert resize and list(self.cache.image_size) == list(image_size), 'cache in {} was built for image_size {}'.format(cache_dir, self.cache.image_size)
+            assert self.cache.paths[:len(self.imgs)] == [str(path) for path in self.imgs], 'cache in {} was built from another file list'.format(cache_dir)
+        self.init_samples(mask_config, image_size, loader, resize, lean)
+
+    def init_samples(self, mask_config, image_size, loader, resize, lean):
+        ''' transforms, masks and batch_stage of the samples, resizing is kept apart so that pixel masks are taken from the resized image '''
+        self.resize_tfs = transforms.Resize((image_size[0], image_size[1])) if resize else (lambda img: img)
         self.tfs = transforms.Compose([
-                transforms.Resize((image_size[0], image_size[1])),
                 transforms.ToTensor(),
                 transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5,0.5, 0.5])
         ])
@@ -68,12 +109,48 @@ class InpaintDataset(data.Dataset):
         self.mask_config = mask_config
         self.mask_mode = self.mask_config['mask_mode']
         self.image_size = image_size
+        self.resize = resize
+        self.pixel_mask = CACHED_MASK_MODES.get(self.mask_mode)
+        ''' mask_bank: {"bank_dir": ..., "num_masks": 10000, "flip": true, "roll": false} draws the random modes from a precomputed bank '''
+        self.mask_bank = None
+        if self.mask_config.get('mask_bank') is not None:
+            self.mask_bank = MaskBank(mask_mode=self.mask_mode, image_size=image_size, **self.mask_config['mask_bank'])
+
+        self.on_device = self.mask_config.get('on_device', False)
+        if self.on_device and self.mask_mode not in INPAINT_MASK_MODES:
+            raise NotImplementedError('Mask mode {} has not been implemented on the device.'.format(self.mask_mode))
+
+        self.lean = lean
+        self.batch_stage = None
+        if self.on_device:
+            self.batch_stage = partial(stage_masked_batch, make_mask=partial(masks_like, batch_inpaint_masks, self.mask_mode))
+        elif self.cache is not None or self.lean:
+            self.batch_stage = partial(stage_masked_batch, make_mask=partial(self.pixel_mask, channel_axis=-3) if self.pixel_mask is not None else None)
 
     def __getitem__(self, index):
-        ret = {}
         path = self.imgs[index]
-        img = self.tfs(self.loader(path))
-        mask = self.get_mask(path)
+        if self.cache is not None:
+            return self.get_cached(index, path)
+        return self.get_sample(self.loader(path), path)
+
+    def get_sample(self, img, path, mask=None):
+        ''' sample of a decoded image, a given [1, h, w] uint8 mask (mask_mode 'file') replaces the one of mask_mode '''
+        ret = {}
+        img = self.resize_tfs(img)
+        if mask is None and self.pixel_mask is not None:
+            mask = self.get_pixel_mask(np.asarray(img))
+        elif mask is None and not self.on_device:
+            mask = self.get_mask(path, image_size=None if self.resize else [img.height, img.width])
+        if self.on_device or self.lean:
+            ''' the rest of the sample is left to batch_stage '''
+            ret['gt_image'] = torch.from_numpy(np.array(img)).permute(2,0,1) if self.lean else self.tfs(img)
+            if mask is not None and self.lean:
+                ret['mask_bits'] = pack_mask_bits(mask)
+            elif mask is not None:
+                ret['mask'] = mask
+            ret['path'] = path.rsplit("/")[-1].rsplit("\\")[-1]
+            return ret
+        img = self.tfs(img)
         cond_image = img*(1. - mask) + mask*torch.randn_like(img)
         mask_img = img*(1. - mask) + mask
 
@@ -87,26 +164,42 @@ class InpaintDataset(data.Dataset):
     def __len__(self):
         return len(self.imgs)
 
-    def get_mask(self, image_path):
-        if self.mask_mode == 'bbox':
-            mask = bbox2mask(self.image_size, random_bbox())
+    def get_cached(self, index, path):
+        ''' uint8 [3, h, w] image and its mask without decoding, cond_image and mask_image are left to batch_stage '''
+        ret = {}
+        ret['gt_image'] = torch.from_numpy(self.cache.images[index]).permute(2,0,1)
+        if self.cache.masks is not None and self.mask_mode == self.cache.mask_mode:
+            ret['mask'] = torch.from_numpy(self.cache.masks[index]).permute(2,0,1)
+        elif self.pixel_mask is None and not self.on_device:
+            ret['mask'] = self.get_mask(path)
+        if self.lean and 'mask' in ret:
+            ret['mask_bits'] = pack_mask_bits(ret.pop('mask'))
+        ret['path'] = path.rsplit("/")[-1].rsplit("\\")[-1]
+        return ret
+
+    def get_pixel_mask(self, img_array):
+        ''' white_pixels | red_pixels mask of the decoded uint8 image '''
+        return torch.from_numpy(self.pixel_mask(img_array)).permute(2,0,1)
+
+    def get_mask(self, image_path, image_size=None):
+        image_size = image_size or self.image_size
+        if self.mask_bank is not None and list(image_size) == self.mask_bank.image_size:
+            mask = self.mask_bank.sample()
+        elif self.mask_mode == 'bbox':
+            mask = bbox2mask(image_size, random_bbox())
         elif self.mask_mode == 'center':
-            h, w = self.image_size
-            mask = bbox2mask(self.image_size, (h//4, w//4, h//2, w//2))
+            h, w = image_size
+            mask = bbox2mask(image_size, (h//4, w//4, h//2, w//2))
         elif self.mask_mode == 'irregular':
-            mask = get_irregular_mask(self.image_size)
+            mask = get_irregular_mask(image_size)
         elif self.mask_mode == 'free_form':
-            mask = brush_stroke_mask(self.image_size)
+            mask = brush_stroke_mask(image_size)
         elif self.mask_mode == 'hybrid':
-            regular_mask = bbox2mask(self.image_size, random_bbox())
-            irregular_mask = brush_stroke_mask(self.image_size, )
+            regular_mask = bbox2mask(image_size, random_bbox())
+            irregular_mask = brush_stroke_mask(image_size, )
             mask = regular_mask | irregular_mask
         elif self.mask_mode == 'from_image':
-            mask = create_mask_from_image(self.image_size)
-        elif self.mask_mode == 'white_pixels':
-            mask = get_mask_from_image_white_pixels(self.image_size, image_path)
-        elif self.mask_mode == 'red_pixels':
-            mask = get_mask_from_image_red_pixels(self.image_size, image_path)
+            mask = create_mask_from_image(image_size)
         elif self.mask_mode == 'file':
             pass
         else:
@@ -115,15 +208,88 @@ class InpaintDataset(data.Dataset):
         return torch.from_numpy(mask).permute(2,0,1)
 
 
+class InpaintShardDataset(InpaintDataset, data.IterableDataset):
+    """
+    InpaintDataset streamed from the tar shards of preprocess/build_inpaint_shards.py. the shards are shuffled every epoch
+    (set_epoch) and split over the GPUs and then over the dataloader workers, a buffer of shuffle_buffer samples shuffles
+    within them. every GPU yields the same number of samples, like DistributedSampler, whole batches per worker so that
+    the dataloader length is exact. masks stored in the shards replace the ones of mask_mode.
+    """
+    def __init__(self, shard_root, mask_config={}, data_len=-1, image_size=[512, 512], shuffle=True, shuffle_buffer=1000, seed=0, lean=False):
+        index = load_shard_index(shard_root)
+        self.shards = [os.path.join(shard_root, shard['name']) for shard in index['shards']]
+        self.shard_counts = {os.path.join(shard_root, shard['name']): shard['count'] for shard in index['shards']}
+        self.num_samples = sum(shard['count'] for shard in index['shards'])
+        if data_len > 0:
+            self.num_samples = min(self.num_samples, int(data_len))
+        self.shuffle, self.shuffle_buffer, self.seed, self.epoch = shuffle, shuffle_buffer, seed, 0
+        self.rank, self.world_size = (dist.get_rank(), dist.get_world_size()) if dist.is_available() and dist.is_initialized() else (0, 1)
+        self.batch_size, self.num_workers = 1, 0
+        self.cache = None
+        self.init_samples(mask_config, image_size, pil_loader, True, lean)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_loader(self, batch_size, num_workers):
+        ''' called by define_dataloader, the samples of every worker are whole batches '''
+        self.batch_size, self.num_workers = batch_size, num_workers
+
+    def __len__(self):
+        ''' samples per GPU, rounded up to whole batches as DistributedSampler rounds up to whole replicas '''
+        num_batches = math.ceil(math.ceil(self.num_samples / self.world_size) / self.batch_size)
+        return num_batches * self.batch_size
+
+    def __iter__(self):
+        worker = data.get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        rng = random.Random(((self.seed * 1000 + self.epoch) * 1000 + self.rank) * 1000 + worker_id)
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(self.seed * 1000 + self.epoch).shuffle(shards)
+        shards = shards[self.rank::self.world_size] or shards[self.rank % len(shards):][:1]
+        worker_shards = [shards[w::num_workers] or shards[w % len(shards):][:1] for w in range(num_workers)]
+        ''' the batches of this GPU are split over the workers in proportion to the samples in their shards '''
+        sizes = [sum(self.shard_counts[shard] for shard in ws) for ws in worker_shards]
+        quotas = [len(self) // self.batch_size * size / sum(sizes) for size in sizes]
+        batches = [int(quota) for quota in quotas]
+        for w in sorted(range(num_workers), key=lambda w: batches[w] - quotas[w])[:len(self) // self.batch_size - sum(batches)]:
+            batches[w] += 1
+
+        buffer = []
+        for sample in self.iter_samples(worker_shards[worker_id], batches[worker_id] * self.batch_size):
+            buffer.append(sample)
+            if len(buffer) >= (self.shuffle_buffer if self.shuffle else 1):
+                yield buffer.pop(rng.randrange(len(buffer)))
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def iter_samples(self, shards, budget):
+        ''' budget samples of the shards, which are read again from the start when they run out '''
+        count = 0
+        while count < budget:
+            for shard in shards:
+                for sample in iter_shard(shard):
+                    if count == budget:
+                        return
+                    img = Image.open(io.BytesIO(sample['image'])).convert('RGB')
+                    mask = None
+                    if 'mask' in sample:
+                        mask = Image.open(io.BytesIO(sample['mask'])).convert('L').resize((self.image_size[1], self.image_size[0]), Image.NEAREST)
+                        mask = torch.from_numpy((np.array(mask) > 0).astype(np.uint8)).unsqueeze(0)
+                    count += 1
+                    yield self.get_sample(img, sample['path'], mask)
+
+
 class UncroppingDataset(data.Dataset):
-    def __init__(self, data_root, mask_config={}, data_len=-1, image_size=[256, 256], loader=pil_loader):
+    def __init__(self, data_root, mask_config={}, data_len=-1, image_size=[256, 256], loader=pil_loader, lean=False):
         imgs = make_dataset(data_root)
         if data_len > 0:
             self.imgs = imgs[:int(data_len)]
         else:
             self.imgs = imgs
+        self.resize_tfs = transforms.Resize((image_size[0], image_size[1]))
         self.tfs = transforms.Compose([
-                transforms.Resize((image_size[0], image_size[1])),
                 transforms.ToTensor(),
                 transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5,0.5, 0.5])
         ])
@@ -131,11 +297,28 @@ class UncroppingDataset(data.Dataset):
         self.mask_config = mask_config
         self.mask_mode = self.mask_config['mask_mode']
         self.image_size = image_size
+        ''' mask_config on_device draws the masks of UNCROP_MASK_MODES for the whole batch in batch_stage, lean samples are as in InpaintDataset '''
+        self.on_device = self.mask_config.get('on_device', False)
+        self.lean = lean
+        self.batch_stage = None
+        if self.on_device:
+            if self.mask_mode not in UNCROP_MASK_MODES:
+                raise NotImplementedError('Mask mode {} has not been implemented on the device.'.format(self.mask_mode))
+            self.batch_stage = partial(stage_masked_batch, make_mask=partial(masks_like, batch_uncrop_masks, self.mask_mode))
+        elif self.lean:
+            self.batch_stage = stage_masked_batch
 
     def __getitem__(self, index):
         ret = {}
         path = self.imgs[index]
-        img = self.tfs(self.loader(path))
+        img = self.resize_tfs(self.loader(path))
+        if self.on_device or self.lean:
+            ret['gt_image'] = torch.from_numpy(np.array(img)).permute(2,0,1) if self.lean else self.tfs(img)
+            if not self.on_device:
+                ret['mask_bits'] = pack_mask_bits(self.get_mask())
+            ret['path'] = path.rsplit("/")[-1].rsplit("\\")[-1]
+            return ret
+        img = self.tfs(img)
         mask = self.get_mask()
         cond_image = img*(1. - mask) + mask*torch.randn_like(img)
         mask_img = img*(1. - mask) + mask
@@ -169,7 +352,7 @@ class UncroppingDataset(data.Dataset):
 
 
 class ColorizationDataset(data.Dataset):
-    def __init__(self, data_root, data_flist, data_len=-1, image_size=[224, 224], loader=pil_loader):
+    def __init__(self, data_root, data_flist, data_len=-1, image_size=[224, 224], loader=pil_loader, packed=False):
         self.data_root = data_root
         flist = make_dataset(data_flist)
         if data_len > 0:
@@ -183,13 +366,23 @@ class ColorizationDataset(data.Dataset):
         ])
         self.loader = loader
         self.image_size = image_size
+        ''' color.npy and gray.npy of mirflickr25k_preprocess.py --output packed instead of one PNG per image '''
+        self.packed = packed
+        if packed:
+            self.color = np.load(os.path.join(data_root, 'color.npy'), mmap_mode='r')
+            self.gray = np.load(os.path.join(data_root, 'gray.npy'), mmap_mode='r')
 
     def __getitem__(self, index):
         ret = {}
         file_name = str(self.flist[index]).zfill(5) + '.png'
 
-        img = self.tfs(self.loader('{}/{}/{}'.format(self.data_root, 'color', file_name)))
-        cond_image = self.tfs(self.loader('{}/{}/{}'.format(self.data_root, 'gray', file_name)))
+        if self.packed:
+            idx = int(self.flist[index])
+            img = self.tfs(Image.fromarray(np.asarray(self.color[idx])))
+            cond_image = self.tfs(Image.fromarray(np.asarray(self.gray[idx])).convert('RGB'))
+        else:
+            img = self.tfs(self.loader('{}/{}/{}'.format(self.data_root, 'color', file_name)))
+            cond_image = self.tfs(self.loader('{}/{}/{}'.format(self.data_root, 'gray', file_name)))
 
         ret['gt_image'] = img
         ret['cond_image'] = cond_image
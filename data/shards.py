@@ -0,0 +1,65 @@
+"""
+tar shards for streaming datasets. the images of a file list are packed as they are, with optional mask PNGs, into
+shard-00000.tar, shard-00001.tar, ... so that they are read sequentially instead of one small file at a time.
+members of a sample share a key: <key>.<image ext>, <key>.mask.png and <key>.path (the original file name).
+shards.json lists the shards and their sample counts.
+"""
+import io
+import json
+import os
+import tarfile
+
+INDEX_NAME = 'shards.json'
+
+def _add_member(tar, name, payload):
+    info = tarfile.TarInfo(name)
+    info.size = len(payload)
+    tar.addfile(info, io.BytesIO(payload))
+
+def write_shards(paths, shard_dir, shard_size=1000, mask_dir=None):
+    """
+    pack paths into shards of shard_size samples. with mask_dir the mask of an image is mask_dir/<file name> (PNG), as
+    used by mask_mode 'file'.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = []
+    for start in range(0, len(paths), shard_size):
+        name = 'shard-{:05d}.tar'.format(len(shards))
+        with tarfile.open(os.path.join(shard_dir, name), 'w') as tar:
+            for idx, path in enumerate(paths[start:start + shard_size], start):
+                key, file_name = '{:08d}'.format(idx), os.path.basename(path)
+                with open(path, 'rb') as f:
+                    _add_member(tar, '{}{}'.format(key, os.path.splitext(file_name)[1].lower()), f.read())
+                if mask_dir is not None:
+                    with open(os.path.join(mask_dir, os.path.splitext(file_name)[0] + '.png'), 'rb') as f:
+                        _add_member(tar, '{}.mask.png'.format(key), f.read())
+                _add_member(tar, '{}.path'.format(key), file_name.encode('utf-8'))
+        shards.append({'name': name, 'count': len(paths[start:start + shard_size])})
+    with open(os.path.join(shard_dir, INDEX_NAME), 'w') as f:
+        json.dump({'shards': shards, 'masks': mask_dir is not None}, f)
+
+def load_shard_index(shard_dir):
+    with open(os.path.join(shard_dir, INDEX_NAME), 'r') as f:
+        return json.load(f)
+
+def iter_shard(path):
+    ''' samples of a shard in order, as dicts {'image': bytes, 'mask': bytes (optional), 'path': str} '''
+    sample, current_key = {}, None
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, ext = member.name.split('.', 1)
+            if key != current_key and sample:
+                yield sample
+                sample = {}
+            current_key = key
+            payload = tar.extractfile(member).read()
+            if ext == 'path':
+                sample['path'] = payload.decode('utf-8')
+            elif ext == 'mask.png':
+                sample['mask'] = payload
+            else:
+                sample['image'] = payload
+    if sample:
+        yield sample
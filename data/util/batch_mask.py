@@ -0,0 +1,132 @@
+"""
+batched torch versions of the mask generators in mask.py, a whole [b, 1, h, w] uint8 mask batch is drawn at once on the
+device of the batch. boxes are rasterised by comparing coordinates, brush strokes by the distance of the pixels to
+their segments.
+"""
+import math
+import numpy as np
+import torch
+
+
+def _randint(low, high, size, device):
+    ''' integers in [low, high) like np.random.randint, low and high may be tensors '''
+    return (torch.rand(size, device=device) * (high - low)).long() + low
+
+def boxes_to_masks(boxes, image_size):
+    ''' (top, left, height, width) tensors of shape [b] to a [b, 1, h, w] uint8 mask batch, as bbox2mask does per box '''
+    top, left, height, width = (v.view(-1, 1, 1) for v in boxes)
+    rows = torch.arange(image_size[0], device=top.device).view(1, -1, 1)
+    cols = torch.arange(image_size[1], device=top.device).view(1, 1, -1)
+    inside = (rows >= top) & (rows < top + height) & (cols >= left) & (cols < left + width)
+    return inside.unsqueeze(1).to(torch.uint8)
+
+def batch_random_bbox(batch_size, image_size, max_bbox_shape=(128, 128), max_bbox_delta=(40, 40), min_margin=(20, 20), device=None):
+    ''' random_bbox for a batch '''
+    img_h, img_w = image_size
+    max_mask_h, max_mask_w = max_bbox_shape
+    if img_h - max_mask_h < 2 * min_margin[0] or img_w - max_mask_w < 2 * min_margin[1]:
+        raise ValueError(f'Margin {min_margin} cannot be satisfied for img shape {image_size} and mask shape {max_bbox_shape}')
+    top = _randint(min_margin[0], img_h - min_margin[0] - max_mask_h, batch_size, device)
+    left = _randint(min_margin[1], img_w - min_margin[1] - max_mask_w, batch_size, device)
+    # randomly shrink the shape of mask box, the top left corner moves with it
+    delta_top = _randint(0, max_bbox_delta[0] // 2 + 1, batch_size, device)
+    delta_left = _randint(0, max_bbox_delta[1] // 2 + 1, batch_size, device)
+    return (top + delta_top, left + delta_left, max_mask_h - delta_top, max_mask_w - delta_left)
+
+def batch_cropping_bbox(batch_size, image_size, mask_mode='onedirection', device=None):
+    ''' random_cropping_bbox for a batch '''
+    h, w = image_size
+    if mask_mode == 'onedirection':
+        # left half, top half, bottom half, right half
+        table = torch.tensor([[0, 0, h, w//2], [0, 0, h//2, w], [h//2, 0, h//2, w], [0, w//2, h, w//2]], device=device)
+        return tuple(table[_randint(0, 4, batch_size, device)].unbind(1))
+    target_area = (h*w)//2
+    width = _randint(target_area//h, w, batch_size, device)
+    height = target_area // width
+    top = _randint(0, h - height, batch_size, device)
+    left = _randint(0, w - width, batch_size, device)
+    return (top, left, height, width)
+
+def _segment_distance_sq(rows, cols, start, end):
+    ''' squared distance of every pixel to the segments start-end, start and end are [b, 2] (x, y), the result is [b, h, w] '''
+    x0, y0 = (v.view(-1, 1, 1) for v in start.unbind(1))
+    dx, dy = (v.view(-1, 1, 1) for v in (end - start).unbind(1))
+    px, py = cols - x0, rows - y0
+    t = ((px * dx + py * dy) / (dx * dx + dy * dy).clamp(min=1e-6)).clamp_(0, 1)
+    return (px - t * dx).square_() + (py - t * dy).square_()
+
+def batch_brush_stroke_mask(batch_size, image_size, num_vertices=(4, 12), mean_angle=2 * math.pi / 5, angle_range=2 * math.pi / 15,
+        brush_width=(12, 40), max_loops=4, device=None):
+    """
+    brush_stroke_mask for a batch. every stroke is a polyline of a random number of vertices whose segments are drawn with
+    the brush width, the vertices get round caps like the ellipses of brush_stroke_mask.
+    """
+    img_h, img_w = image_size
+    average_radius = math.sqrt(img_h * img_h + img_w * img_w) / 8
+    rows = torch.arange(img_h, device=device, dtype=torch.float32).view(1, -1, 1)
+    cols = torch.arange(img_w, device=device, dtype=torch.float32).view(1, 1, -1)
+    mask = torch.zeros(batch_size, img_h, img_w, dtype=torch.bool, device=device)
+
+    loop_num = _randint(1, max_loops, batch_size, device)
+    for loop_n in range(max_loops - 1):
+        num_vertex = _randint(num_vertices[0], num_vertices[1], batch_size, device)
+        angle_min = mean_angle - torch.rand(batch_size, device=device) * angle_range
+        angle_max = mean_angle + torch.rand(batch_size, device=device) * angle_range
+        radius = (torch.randn(batch_size, num_vertices[1], device=device) * (average_radius // 2) + average_radius).clamp(0, 2 * average_radius)
+        width = _randint(brush_width[0], brush_width[1], batch_size, device).view(-1, 1, 1)
+        drawn = (loop_n < loop_num).view(-1, 1, 1)
+
+        vertex = torch.stack([_randint(0, img_w, batch_size, device), _randint(0, img_h, batch_size, device)], 1).float()
+        for i in range(num_vertices[1] - 1):
+            angle = angle_min + torch.rand(batch_size, device=device) * (angle_max - angle_min)
+            if i % 2 == 0:
+                angle = 2 * math.pi - angle
+            new_vertex = torch.stack([
+                (vertex[:, 0] + radius[:, i] * torch.cos(angle)).clamp(0, img_w),
+                (vertex[:, 1] + radius[:, i] * torch.sin(angle)).clamp(0, img_h)], 1).floor()
+            on_stroke = drawn & (i < num_vertex).view(-1, 1, 1)
+            mask |= on_stroke & (_segment_distance_sq(rows, cols, vertex, new_vertex) <= (width / 2) ** 2)
+            vertex = new_vertex
+    return mask.unsqueeze(1).to(torch.uint8)
+
+''' modes that InpaintDataset and UncroppingDataset can leave to the device with mask_config on_device '''
+INPAINT_MASK_MODES = ['bbox', 'center', 'free_form', 'hybrid']
+UNCROP_MASK_MODES = ['onedirection', 'fourdirection', 'hybrid']
+
+def batch_inpaint_masks(mask_mode, batch_size, image_size, device=None):
+    ''' a [b, 1, h, w] uint8 mask batch of an InpaintDataset mask mode '''
+    if mask_mode == 'bbox':
+        return boxes_to_masks(batch_random_bbox(batch_size, image_size, device=device), image_size)
+    elif mask_mode == 'center':
+        h, w = image_size
+        box = torch.tensor([h//4, w//4, h//2, w//2], device=device).repeat(batch_size, 1)
+        return boxes_to_masks(box.unbind(1), image_size)
+    elif mask_mode == 'free_form':
+        return batch_brush_stroke_mask(batch_size, image_size, device=device)
+    elif mask_mode == 'hybrid':
+        regular_mask = boxes_to_masks(batch_random_bbox(batch_size, image_size, device=device), image_size)
+        return regular_mask | batch_brush_stroke_mask(batch_size, image_size, device=device)
+    raise NotImplementedError(f'Mask mode {mask_mode} has not been implemented on the device.')
+
+def batch_uncrop_masks(mask_mode, batch_size, image_size, device=None):
+    ''' a [b, 1, h, w] uint8 mask batch of an UncroppingDataset mask mode, hybrid picks one- or four-direction per sample '''
+    if mask_mode in ['onedirection', 'fourdirection']:
+        return boxes_to_masks(batch_cropping_bbox(batch_size, image_size, mask_mode, device=device), image_size)
+    elif mask_mode == 'hybrid':
+        one = boxes_to_masks(batch_cropping_bbox(batch_size, image_size, 'onedirection', device=device), image_size)
+        four = boxes_to_masks(batch_cropping_bbox(batch_size, image_size, 'fourdirection', device=device), image_size)
+        return torch.where(torch.rand(batch_size, 1, 1, 1, device=device) < 0.5, one, four)
+    raise NotImplementedError(f'Mask mode {mask_mode} has not been implemented on the device.')
+
+def masks_like(generate, mask_mode, img):
+    ''' mask batch of generate (batch_inpaint_masks | batch_uncrop_masks) for the size and device of an image batch '''
+    return generate(mask_mode, img.shape[0], tuple(img.shape[-2:]), img.device)
+
+def pack_mask_bits(mask):
+    ''' [1, h, w] uint8 mask to [h, ceil(w/8)] bytes, 8 pixels per byte along the width '''
+    return torch.from_numpy(np.packbits(mask[0].numpy(), axis=-1))
+
+def unpack_mask_bits(bits, width):
+    ''' [b, h, ceil(w/8)] bytes of pack_mask_bits back to a [b, 1, h, w] uint8 mask batch, on the device of bits '''
+    shifts = torch.arange(7, -1, -1, device=bits.device, dtype=torch.uint8)
+    return ((bits.unsqueeze(-1) >> shifts) & 1).flatten(-2)[..., :width].unsqueeze(1)
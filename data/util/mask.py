@@ -1,8 +1,10 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import functools
 import math
 
 import cv2
 import numpy as np
+import torch
 from PIL import Image, ImageDraw
 import random
 import os
@@ -366,11 +368,15 @@ def create_mask_from_image(img_shape):
 #    image_path = "/home/jovyan/cloud/Palette/masks/512/horizontal-bottom/MASK_171.png"
     image_path = "/home/jovyan/cloud/Palette/masks/512/complex/MASK_1_18.png"
     
-    # Load the image
-    image = Image.open(image_path)
-    
-    # Convert the image to grayscale
-    image = image.convert('L')
+    # the file is read once per process, callers get their own copy
+    return load_mask_image(image_path).copy()
+
+
+@functools.lru_cache(maxsize=16)
+def load_mask_image(image_path):
+    """ binary [h, w, 1] uint8 mask of the non-black pixels of a mask image """
+    # Load the image and convert it to grayscale
+    image = Image.open(image_path).convert('L')
     
     # Invert the image (black becomes white and white becomes black)
     #image = Image.eval(image, lambda x: 255 - x)
@@ -385,61 +391,38 @@ def create_mask_from_image(img_shape):
     return mask
 
 
-def get_mask_from_image_white_pixels(image_size, image_path):
+def _pixel_mask(img, condition, channel_axis):
     """
-    Advanced white pixel detection for IPFZ maps.
-    Specifically targets pure white pixels (255, 255, 255).
-    """    
-    original_img = Image.open(image_path).convert('RGB')
-    original_img = original_img.resize((image_size[1], image_size[0]))     
-    img_array = np.array(original_img)
-
-    # all three channels are equal and have value more than 210
-    r_equal_g = img_array[:, :, 0] == img_array[:, :, 1]
-    g_equal_b = img_array[:, :, 1] == img_array[:, :, 2]
-    channels_equal = r_equal_g & g_equal_b
-    value_above_threshold = img_array[:, :, 0] > 210
-
-    mask = (channels_equal & value_above_threshold).astype(np.uint8)
-    
-    white_pixel_count = np.sum(mask)
-    total_pixels = mask.shape[0] * mask.shape[1]
-    white_percentage = (white_pixel_count / total_pixels) * 100
-    print(f"White pixels detected: {white_pixel_count}/{total_pixels} ({white_percentage:.2f}%) in {os.path.basename(image_path)}")
-    print(f"Image shape: {img_array.shape}, Mask shape: {mask.shape}")
-
-    mask = mask[:, :, np.newaxis]
+    mask of the pixels of a uint8 image that satisfy condition(r, g, b), for numpy [..., h, w, 3] arrays (channel_axis=-1)
+    or torch [..., 3, h, w] tensors (channel_axis=-3), e.g. a batch on the device. the mask keeps a channel axis of size 1.
+    """
+    trailing = (slice(None),) * (-channel_axis - 1)
+    r, g, b = (img[(Ellipsis, c) + trailing] for c in range(3))
+    mask = condition(r, g, b)[(Ellipsis, None) + trailing]
+    return mask.to(torch.uint8) if torch.is_tensor(mask) else mask.astype(np.uint8)
 
-    if not np.any(mask):
-        mask = np.zeros((image_size[0], image_size[1], 1), dtype=np.uint8)
-    
-    return mask
+def white_pixels_mask(img, channel_axis=-1):
+    """
+    white pixel detection for IPFZ maps: all three channels are equal and have value more than 210.
+    """
+    return _pixel_mask(img, lambda r, g, b: (r == g) & (g == b) & (r > 210), channel_axis)
 
-def get_mask_from_image_red_pixels(image_size, image_path):
+def red_pixels_mask(img, channel_axis=-1):
     """
-    Advanced white pixel detection for IPFZ maps.
-    Specifically targets pure red pixels (255, 0, 0).
-    """    
-    original_img = Image.open(image_path).convert('RGB')
-    original_img = original_img.resize((image_size[1], image_size[0]))     
-    img_array = np.array(original_img)
-
-    # only red channel are equal to 255
-    red_channel = img_array[:, :, 0] == 255
-    green_channel = img_array[:, :, 1] == 0
-    blue_channel = img_array[:, :, 2] == 0
-    
-    mask = (red_channel & green_channel & blue_channel).astype(np.uint8)
-    
-    red_pixel_count = np.sum(mask)
-    total_pixels = mask.shape[0] * mask.shape[1]
-    red_percentage = (red_pixel_count / total_pixels) * 100
-    print(f"Red pixels detected: {red_pixel_count}/{total_pixels} ({red_percentage:.2f}%) in {os.path.basename(image_path)}")
-    print(f"Image shape: {img_array.shape}, Mask shape: {mask.shape}")
+    red pixel detection for IPFZ maps: pure red pixels (255, 0, 0).
+    """
+    return _pixel_mask(img, lambda r, g, b: (r == 255) & (g == 0) & (b == 0), channel_axis)
 
-    mask = mask[:, :, np.newaxis]
+def get_mask_from_image_white_pixels(image_size, image_path):
+    """
+    white pixel mask of an image file resized to image_size, InpaintDataset uses white_pixels_mask on the image it already decoded.
+    """
+    img_array = np.array(Image.open(image_path).convert('RGB').resize((image_size[1], image_size[0])))
+    return white_pixels_mask(img_array)
 
-    if not np.any(mask):
-        mask = np.zeros((image_size[0], image_size[1], 1), dtype=np.uint8)
-    
-    return mask
\ No newline at end of file
+def get_mask_from_image_red_pixels(image_size, image_path):
+    """
+    red pixel mask of an image file resized to image_size, InpaintDataset uses red_pixels_mask on the image it already decoded.
+    """
+    img_array = np.array(Image.open(image_path).convert('RGB').resize((image_size[1], image_size[0])))
+    return red_pixels_mask(img_array)
@@ -0,0 +1,75 @@
+import os
+from multiprocessing import Pool
+import numpy as np
+
+import core.util as Util
+from .mask import bbox2mask, brush_stroke_mask, get_irregular_mask, random_bbox, create_mask_from_image
+
+''' the random modes of InpaintDataset.get_mask, each generator returns a uint8 [h, w, 1] mask '''
+MASK_GENERATORS = {
+    'bbox': lambda image_size: bbox2mask(image_size, random_bbox()),
+    'irregular': lambda image_size: get_irregular_mask(image_size),
+    'free_form': lambda image_size: brush_stroke_mask(image_size),
+    'hybrid': lambda image_size: bbox2mask(image_size, random_bbox()) | brush_stroke_mask(image_size),
+    'from_image': lambda image_size: create_mask_from_image(image_size),
+}
+
+def _generate(args):
+    ''' one chunk of packed masks, every chunk has its own seed so that forked workers do not repeat each other '''
+    mask_mode, image_size, num_masks, seed = args
+    np.random.seed(seed)
+    return np.stack([np.packbits(MASK_GENERATORS[mask_mode](image_size)[..., 0], axis=-1) for _ in range(num_masks)])
+
+def build_mask_bank(path, mask_mode, image_size, num_masks, seed=0, num_workers=8, chunk_size=64):
+    """
+    generate num_masks masks of mask_mode and store them bit-packed along the width, as a uint8 [n, h, ceil(w/8)] .npy file.
+    the file is written next to path and renamed at the end, so concurrent builders (e.g. DDP ranks) never read a partial bank.
+    """
+    if mask_mode not in MASK_GENERATORS:
+        raise NotImplementedError('Mask mode {} can not be stored in a mask bank.'.format(mask_mode))
+    h, w = image_size
+    tmp_path = '{}.{}.tmp.npy'.format(path, os.getpid())
+    bank = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(num_masks, h, (w + 7) // 8))
+    chunks = [(mask_mode, image_size, min(chunk_size, num_masks - start), seed + idx) for idx, start in enumerate(range(0, num_masks, chunk_size))]
+    with Pool(num_workers) as pool:
+        for idx, packed in enumerate(pool.imap(_generate, chunks)):
+            bank[idx*chunk_size : idx*chunk_size + len(packed)] = packed
+    bank.flush()
+    del bank
+    os.replace(tmp_path, path)
+
+
+class MaskBank():
+    """
+    random access to a bank of build_mask_bank, a sample unpacks one stored mask and, for variety, flips it
+    horizontally / vertically and rolls it by a random offset. the bank is built on first use, under DDP by GPU 0 only.
+    from_image always gives the same mask, so its bank holds that single mask, which is neither flipped nor rolled.
+    """
+    def __init__(self, bank_dir, mask_mode, image_size, num_masks=10000, flip=True, roll=False, num_workers=8, seed=0):
+        if mask_mode == 'from_image':
+            num_masks, flip, roll = 1, False, False
+        self.image_size = list(image_size)
+        self.flip = flip
+        self.roll = roll
+        path = os.path.join(bank_dir, '{}_{}x{}_{}_seed{}.npy'.format(mask_mode, image_size[0], image_size[1], num_masks, seed))
+        with Util.rank_zero_first():
+            if not os.path.exists(path):
+                os.makedirs(bank_dir, exist_ok=True)
+                build_mask_bank(path, mask_mode, image_size, num_masks, seed=seed, num_workers=num_workers)
+        self.bank = np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.bank)
+
+    def sample(self):
+        ''' uint8 [h, w, 1] mask like the generators return '''
+        h, w = self.image_size
+        mask = np.unpackbits(self.bank[np.random.randint(len(self.bank))], axis=-1, count=w)
+        if self.flip:
+            if np.random.rand() < 0.5:
+                mask = mask[:, ::-1]
+            if np.random.rand() < 0.5:
+                mask = mask[::-1, :]
+        if self.roll:
+            mask = np.roll(mask, (np.random.randint(h), np.random.randint(w)), axis=(0, 1))
+        return np.ascontiguousarray(mask)[:, :, np.newaxis]
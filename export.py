@@ -0,0 +1,70 @@
+import argparse
+import logging
+import os
+import numpy as np
+import torch
+
+import core.praser as Praser
+from models import define_network
+from models.network import make_beta_schedule
+
+def export_unet(network, output, formats=('onnx', 'torchscript'), opset=18, in_channel=6, image_size=256, logger=None):
+    """ write network.denoise_fn to <output>.onnx and <output>.pt, traced on an example input of image_size """
+    logger = logger or logging.getLogger('export')
+    unet = network.denoise_fn
+    ''' example input for tracing, batch and spatial axes are dynamic in the ONNX graph '''
+    x = torch.randn(1, in_channel, image_size, image_size)
+    gammas = network.gammas[-1:].view(1, 1)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    ''' no_grad also bypasses gradient checkpointing, which cannot be exported '''
+    with torch.no_grad():
+        if 'onnx' in formats:
+            torch.onnx.export(unet, (x, gammas), '{}.onnx'.format(output), opset_version=opset,
+                input_names=['x', 'gammas'], output_names=['noise'],
+                dynamic_axes={'x': {0: 'batch', 2: 'height', 3: 'width'}, 'gammas': {0: 'batch'}, 'noise': {0: 'batch', 2: 'height', 3: 'width'}})
+            logger.info('Exported ONNX to {}.onnx'.format(output))
+        if 'torchscript' in formats:
+            traced = torch.jit.trace(unet, (x, gammas), check_trace=False)
+            traced.save('{}.pt'.format(output))
+            logger.info('Exported TorchScript to {}.pt'.format(output))
+
+def save_schedule(network, output, phase='test', logger=None):
+    """ the schedule buffers of the network and the betas of phase in <output>_schedule.npz, as read by models.runtime.Sampler """
+    logger = logger or logging.getLogger('export')
+    schedule = {name: buffer.cpu().numpy() for name, buffer in network.named_buffers(recurse=False)}
+    betas = make_beta_schedule(**network.beta_schedule[phase])
+    schedule['betas'] = betas.detach().cpu().numpy() if isinstance(betas, torch.Tensor) else betas
+    np.savez('{}_schedule.npz'.format(output), **schedule)
+    logger.info('Saved the {} noise schedule to {}_schedule.npz'.format(phase, output))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, help='JSON file for configuration')
+    parser.add_argument('-s', '--state', type=str, help='Checkpoint prefix, e.g. experiments/.../checkpoint/100')
+    parser.add_argument('-o', '--output', type=str, help='Output prefix, writes <output>.onnx, <output>.pt and <output>_schedule.npz')
+    parser.add_argument('--ema', action='store_true', help='Export the EMA weights')
+    parser.add_argument('--phase', type=str, default='test', help='Beta schedule written next to the network')
+    parser.add_argument('--format', type=str, nargs='+', choices=['onnx', 'torchscript'], default=['onnx', 'torchscript'])
+    parser.add_argument('--opset', type=int, default=18, help='18 or newer for the dynamo exporter of recent torch versions')
+    parser.add_argument('--size', type=int, default=None, help='Spatial size of the example input, image_size of the unet by default')
+
+    ''' parser configs '''
+    args = parser.parse_args()
+    opt = Praser.load_config(args.config)
+    opt['phase'] = 'test'
+    logger = logging.getLogger('export')
+    logging.basicConfig(level=logging.INFO)
+
+    ''' network with loaded weights and the schedule buffers of set_new_noise_schedule '''
+    network_opt = opt['model']['which_networks'][0]
+    network = define_network(logger, opt, network_opt)
+    model_path = '{}_{}{}.pth'.format(args.state, network.__class__.__name__, '_ema' if args.ema else '')
+    network.load_state_dict(torch.load(model_path, map_location='cpu'), strict=False)
+    network.set_new_noise_schedule(device=torch.device('cpu'), phase=args.phase)
+    network.eval()
+
+    unet_opt = network_opt['args']['unet']
+    export_unet(network, args.output, formats=args.format, opset=args.opset, in_channel=unet_opt.get('in_channel', 6),
+        image_size=args.size or unet_opt.get('image_size', 256), logger=logger)
+    save_schedule(network, args.output, phase=args.phase, logger=logger)
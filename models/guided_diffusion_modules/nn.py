@@ -6,6 +6,7 @@ import math
 import numpy as np
 import torch 
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class GroupNorm32(nn.GroupNorm):
@@ -59,8 +60,9 @@ def checkpoint(func, inputs, params, flag):
     :param params: a sequence of parameters `func` depends on but does not
                    explicitly take as arguments.
     :param flag: if False, disable gradient checkpointing.
+                 Without gradients (e.g. sampling) there is nothing to save either.
     """
-    if flag:
+    if flag and torch.is_grad_enabled():
         args = tuple(inputs) + tuple(params)
         return CheckpointFunction.apply(func, len(inputs), *args)
     else:
@@ -73,6 +75,13 @@ class CheckpointFunction(torch.autograd.Function):
         ctx.run_function = run_function
         ctx.input_tensors = list(args[:length])
         ctx.input_params = list(args[length:])
+        # the recomputation in backward must run under the same autocast state
+        device_type = ctx.input_tensors[0].device.type
+        ctx.autocast_kwargs = {
+            "device_type": device_type,
+            "enabled": torch.is_autocast_enabled(device_type),
+            "dtype": torch.get_autocast_dtype(device_type),
+        }
         with torch.no_grad():
             output_tensors = ctx.run_function(*ctx.input_tensors)
         return output_tensors
@@ -80,7 +89,7 @@ class CheckpointFunction(torch.autograd.Function):
     @staticmethod
     def backward(ctx, *output_grads):
         ctx.input_tensors = [x.detach().requires_grad_(True) for x in ctx.input_tensors]
-        with torch.enable_grad():
+        with torch.enable_grad(), torch.autocast(**ctx.autocast_kwargs):
             # Fixes a bug where the first op in run_function modifies the
             # Tensor storage in place, which is not allowed for detach()'d
             # Tensors.
@@ -118,6 +127,62 @@ def count_flops_attn(model, _x, y):
     model.total_ops += torch.DoubleTensor([matmul_ops])
 
 
+def attention(q, k, v, backend="einsum", chunk_size=1024):
+    """
+    Attention of every query over all keys, shared by the attention layers of both UNets.
+
+    :param q: an [N x C x T] tensor of queries.
+    :param k: an [N x C x S] tensor of keys.
+    :param v: an [N x C x S] tensor of values.
+    :param backend: einsum (materialises the [N x T x S] weights), sdpa
+                    (torch scaled_dot_product_attention, fused kernels where
+                    available) or chunked (chunk_size queries at a time with a
+                    streaming softmax over chunk_size keys, for CPU).
+    :param chunk_size: number of queries and keys per step of the chunked backend.
+    :return: an [N x C x T] tensor after attention.
+    """
+    ch = q.shape[1]
+    if backend == "einsum":
+        scale = 1 / math.sqrt(math.sqrt(ch))
+        weight = torch.einsum(
+            "bct,bcs->bts", q * scale, k * scale
+        )  # More stable with f16 than dividing afterwards
+        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+        return torch.einsum("bts,bcs->bct", weight, v)
+    elif backend == "sdpa":
+        a = F.scaled_dot_product_attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2))
+        return a.transpose(1, 2)
+    elif backend == "chunked":
+        return chunked_attention(q, k, v, chunk_size)
+    else:
+        raise NotImplementedError(f"Attention backend {backend} has not been implemented.")
+
+
+def chunked_attention(q, k, v, chunk_size=1024):
+    """
+    Attention computed for chunk_size queries at a time, with an online softmax
+    over chunk_size keys at a time, so that at most [N x chunk_size x chunk_size]
+    weights exist at once. Accumulation is done in float32.
+    """
+    scale = 1 / math.sqrt(q.shape[1])
+    k, v = k.float(), v.float()
+    out = []
+    for q_chunk in (q.float() * scale).split(chunk_size, dim=2):
+        running_max = q_chunk.new_full((q_chunk.shape[0], q_chunk.shape[2], 1), -float("inf"))
+        running_sum = q_chunk.new_zeros((q_chunk.shape[0], q_chunk.shape[2], 1))
+        acc = q_chunk.new_zeros((q_chunk.shape[0], q_chunk.shape[2], v.shape[1]))
+        for k_chunk, v_chunk in zip(k.split(chunk_size, dim=2), v.split(chunk_size, dim=2)):
+            weight = torch.einsum("bct,bcs->bts", q_chunk, k_chunk)
+            new_max = torch.maximum(running_max, weight.amax(dim=-1, keepdim=True))
+            weight = torch.exp(weight - new_max)
+            correction = torch.exp(running_max - new_max)
+            running_sum = running_sum * correction + weight.sum(dim=-1, keepdim=True)
+            acc = acc * correction + torch.einsum("bts,bcs->btc", weight, v_chunk)
+            running_max = new_max
+        out.append((acc / running_sum).transpose(1, 2))
+    return torch.cat(out, dim=2).type(q.dtype)
+
+
 def gamma_embedding(gammas, dim, max_period=10000):
     """
     Create sinusoidal timestep embeddings.
@@ -10,7 +10,8 @@ from .nn import (
     zero_module,
     normalization,
     count_flops_attn,
-    gamma_embedding
+    gamma_embedding,
+    attention
 )
 
 class SiLU(nn.Module):
@@ -216,6 +217,8 @@ class AttentionBlock(nn.Module):
         num_head_channels=-1,
         use_checkpoint=False,
         use_new_attention_order=False,
+        attn_backend="einsum",
+        attn_chunk_size=1024,
     ):
         super().__init__()
         self.channels = channels
@@ -231,10 +234,10 @@ class AttentionBlock(nn.Module):
         self.qkv = nn.Conv1d(channels, channels * 3, 1)
         if use_new_attention_order:
             # split qkv before split heads
-            self.attention = QKVAttention(self.num_heads)
+            self.attention = QKVAttention(self.num_heads, attn_backend, attn_chunk_size)
         else:
             # split heads before split qkv
-            self.attention = QKVAttentionLegacy(self.num_heads)
+            self.attention = QKVAttentionLegacy(self.num_heads, attn_backend, attn_chunk_size)
 
         self.proj_out = zero_module(nn.Conv1d(channels, channels, 1))
 
@@ -255,9 +258,11 @@ class QKVAttentionLegacy(nn.Module):
     A module which performs QKV attention. Matches legacy QKVAttention + input/ouput heads shaping
     """
 
-    def __init__(self, n_heads):
+    def __init__(self, n_heads, backend="einsum", chunk_size=1024):
         super().__init__()
         self.n_heads = n_heads
+        self.backend = backend
+        self.chunk_size = chunk_size
 
     def forward(self, qkv):
         """
@@ -269,12 +274,7 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = torch.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = torch.einsum("bts,bcs->bct", weight, v)
+        a = attention(q, k, v, self.backend, self.chunk_size)
         return a.reshape(bs, -1, length)
 
     @staticmethod
@@ -287,9 +287,11 @@ class QKVAttention(nn.Module):
     A module which performs QKV attention and splits in a different order.
     """
 
-    def __init__(self, n_heads):
+    def __init__(self, n_heads, backend="einsum", chunk_size=1024):
         super().__init__()
         self.n_heads = n_heads
+        self.backend = backend
+        self.chunk_size = chunk_size
 
     def forward(self, qkv):
         """
@@ -301,14 +303,13 @@ class QKVAttention(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.chunk(3, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = torch.einsum(
-            "bct,bcs->bts",
-            (q * scale).view(bs * self.n_heads, ch, length),
-            (k * scale).view(bs * self.n_heads, ch, length),
-        )  # More stable with f16 than dividing afterwards
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = torch.einsum("bts,bcs->bct", weight, v.reshape(bs * self.n_heads, ch, length))
+        a = attention(
+            q.reshape(bs * self.n_heads, ch, length),
+            k.reshape(bs * self.n_heads, ch, length),
+            v.reshape(bs * self.n_heads, ch, length),
+            self.backend,
+            self.chunk_size,
+        )
         return a.reshape(bs, -1, length)
 
     @staticmethod
@@ -340,6 +341,8 @@ class UNet(nn.Module):
     :param resblock_updown: use residual blocks for up/downsampling.
     :param use_new_attention_order: use a different attention pattern for potentially
                                     increased efficiency.
+    :param attn_backend: einsum, sdpa or chunked, see nn.attention.
+    :param attn_chunk_size: queries and keys per step of the chunked attention backend.
     """
 
     def __init__(
@@ -361,6 +364,8 @@ class UNet(nn.Module):
         use_scale_shift_norm=True,
         resblock_updown=True,
         use_new_attention_order=False,
+        attn_backend="einsum",
+        attn_chunk_size=1024,
     ):
 
         super().__init__()
@@ -418,6 +423,8 @@ class UNet(nn.Module):
                             num_heads=num_heads,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
+                            attn_backend=attn_backend,
+                            attn_chunk_size=attn_chunk_size,
                         )
                     )
                 self.input_blocks.append(EmbedSequential(*layers))
@@ -461,6 +468,8 @@ class UNet(nn.Module):
                 num_heads=num_heads,
                 num_head_channels=num_head_channels,
                 use_new_attention_order=use_new_attention_order,
+                attn_backend=attn_backend,
+                attn_chunk_size=attn_chunk_size,
             ),
             ResBlock(
                 ch,
@@ -495,6 +504,8 @@ class UNet(nn.Module):
                             num_heads=num_heads_upsample,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
+                            attn_backend=attn_backend,
+                            attn_chunk_size=attn_chunk_size,
                         )
                     )
                 if level and i == res_blocks:
@@ -1,23 +1,77 @@
+import contextlib
+import math
+import os
 import torch
+import torch.nn as nn
 import tqdm
+from functools import partial
 from core.base_model import BaseModel
 from core.logger import LogTracker
+from data import define_batch_stage
+from .quantize import quantize_unet
 import copy
 class EMA():
-    def __init__(self, beta=0.9999):
+    def __init__(self, beta=0.9999, warmup=False):
         super().__init__()
         self.beta = beta
+        self.warmup = warmup
+        self.num_updates = 0
+        self.pending_steps = 0
+        self.residuals = None
+
+    def step(self):
+        ''' count an optimizer step, the next update decays by beta for every counted step '''
+        self.pending_steps += 1
+
+    def get_decay(self):
+        ''' decay of the next update, warmup lowers it while only few updates have been made '''
+        decay = self.beta ** max(self.pending_steps, 1)
+        if self.warmup:
+            decay = min(decay, (1 + self.num_updates) / (10 + self.num_updates))
+        return decay
+
+    @torch.no_grad()
     def update_model_average(self, ma_model, current_model):
-        for current_params, ma_params in zip(current_model.parameters(), ma_model.parameters()):
-            old_weight, up_weight = ma_params.data, current_params.data
-            ma_params.data = self.update_average(old_weight, up_weight)
-    def update_average(self, old, new):
-        if old is None:
-            return new
-        return old * self.beta + (1 - self.beta) * new
+        ''' in-place multi-tensor update, ma_model may live on another device or in another dtype '''
+        ma_params = [p.data for p in ma_model.parameters()]
+        current_params = [p.detach() for p in current_model.parameters()]
+        if any(ma.device != p.device for ma, p in zip(ma_params, current_params)):
+            current_params = [p.to(device=ma.device) for ma, p in zip(ma_params, current_params)]
+        if all(ma.dtype == p.dtype for ma, p in zip(ma_params, current_params)):
+            torch._foreach_lerp_(ma_params, current_params, 1. - self.get_decay())
+        else:
+            self.compensated_lerp_(ma_params, current_params, 1. - self.get_decay())
+        self.num_updates += 1
+        self.pending_steps = 0
+
+    def compensated_lerp_(self, ma_params, current_params, weight):
+        """
+        lerp into lower precision EMA weights, e.g. bfloat16, whose rounding step is larger than the updates of a decay 
+        like 0.9999. what rounding loses is kept in residuals (of the same dtype) and added to the next update, 
+        so the small updates add up instead of being rounded away.
+        """
+        if self.residuals is None:
+            self.residuals = [torch.zeros_like(ma) for ma in ma_params]
+        # residuals of a resumed run are loaded on the training device
+        self.residuals = [r.to(ma.device) for r, ma in zip(self.residuals, ma_params)]
+        average = [ma.float() for ma in ma_params]
+        update = torch._foreach_sub([p.float() for p in current_params], average)
+        torch._foreach_mul_(update, weight)
+        torch._foreach_add_(update, [r.float() for r in self.residuals])
+        torch._foreach_add_(average, update)
+        torch._foreach_copy_(ma_params, average)
+        torch._foreach_copy_(self.residuals, torch._foreach_sub(average, [ma.float() for ma in ma_params]))
+
+    def state_dict(self):
+        return {'num_updates': self.num_updates, 'pending_steps': self.pending_steps, 'residuals': self.residuals}
+
+    def load_state_dict(self, state):
+        self.num_updates = state['num_updates']
+        self.pending_steps = state['pending_steps']
+        self.residuals = state.get('residuals')
 
 class Palette(BaseModel):
-    def __init__(self, networks, losses, sample_num, task, optimizers, ema_scheduler=None, **kwargs):
+    def __init__(self, networks, losses, sample_num, task, optimizers, ema_scheduler=None, num_samples=1, candidate_metrics=False, amp=None, quantize=None, **kwargs):
         ''' must to init BaseModel with kwargs '''
         super(Palette, self).__init__(**kwargs)
 
@@ -27,14 +81,20 @@ class Palette(BaseModel):
         if ema_scheduler is not None:
             self.ema_scheduler = ema_scheduler
             self.netG_EMA = copy.deepcopy(self.netG)
-            self.EMA = EMA(beta=self.ema_scheduler['ema_decay'])
+            self.EMA = EMA(beta=self.ema_scheduler['ema_decay'], warmup=self.ema_scheduler.get('ema_warmup', False))
         else:
             self.ema_scheduler = None
         
         ''' networks can be a list, and must convert by self.set_device function if using multiple GPU. '''
         self.netG = self.set_device(self.netG, distributed=self.opt['distributed'])
         if self.ema_scheduler is not None:
-            self.netG_EMA = self.set_device(self.netG_EMA, distributed=self.opt['distributed'])
+            ''' ema_device (e.g. cpu) and ema_dtype (e.g. bfloat16) keep the EMA weights off the training device or in lower precision '''
+            ema_device, ema_dtype = self.ema_scheduler.get('ema_device', None), self.ema_scheduler.get('ema_dtype', None)
+            if ema_dtype is not None:
+                ema_dtype = getattr(torch, ema_dtype)
+            if ema_device is None:
+                self.netG_EMA = self.set_device(self.netG_EMA, distributed=self.opt['distributed'])
+            self.netG_EMA.to(device=ema_device, dtype=ema_dtype)
         self.load_networks()
 
         self.optG = torch.optim.Adam(list(filter(lambda p: p.requires_grad, self.netG.parameters())), **optimizers[0])
@@ -48,16 +108,44 @@ class Palette(BaseModel):
             self.netG.set_loss(self.loss_fn)
             self.netG.set_new_noise_schedule(phase=self.phase)
 
+        ''' amp: fp16 | bf16 runs the network under autocast for training and sampling, fp16 also scales the loss '''
+        if amp not in [None, 'fp16', 'bf16']:
+            raise NotImplementedError('Mixed precision {} has not been implemented.'.format(amp))
+        self.amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(amp)
+        self.device_type = next(self.netG.parameters()).device.type
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=self.amp_dtype == torch.float16)
+        self.get_network().set_amp(self.amp_dtype)
+
         ''' can rewrite in inherited class for more informations logging '''
-        self.train_metrics = LogTracker(*[m.__name__ for m in losses], phase='train')
-        self.val_metrics = LogTracker(*[m.__name__ for m in self.metrics], phase='val')
-        self.test_metrics = LogTracker(*[m.__name__ for m in self.metrics], phase='test')
+        self.task = task
+        mask_keys = ['mask_ratio', 'empty_masks'] if self.task in ['inpainting','uncropping'] else []
+        self.train_metrics = LogTracker(*[m.__name__ for m in losses], *mask_keys, phase='train')
+        ''' num_samples candidates are restored per input, candidate_metrics also logs the metrics of every candidate as <metric>_<k> '''
+        self.num_samples = num_samples
+        self.candidate_metrics = candidate_metrics and num_samples > 1
+        metric_names = [m.__name__ for m in self.metrics]
+        if self.candidate_metrics:
+            metric_names += ['{}_{}'.format(m.__name__, k) for m in self.metrics for k in range(num_samples)]
+        self.val_metrics = LogTracker(*metric_names, phase='val')
 
         self.sample_num = sample_num
-        self.task = task
+
+        ''' datasets with a batch_stage (e.g. a cached InpaintDataset) hand over uint8 batches that are finished on the device.
+            set before quantization, whose calibration reads test batches through set_input '''
+        self.batch_stage = define_batch_stage(self.phase_loader)
+
+        ''' quantize: int8 UNet for CPU inference in the test phase, report_delta also runs the fp32 UNet on every batch and logs it as <metric>_fp32 '''
+        self.fp32_denoise_fn = None
+        if quantize is not None and self.phase != 'train':
+            self.quantize_network(**quantize)
+            if self.fp32_denoise_fn is not None:
+                metric_names += ['{}_fp32'.format(m.__name__) for m in self.metrics]
+        self.test_metrics = LogTracker(*metric_names, *mask_keys, phase='test')
         
     def set_input(self, data):
         ''' must use set_device in tensor '''
+        if self.batch_stage is not None:
+            data = self.batch_stage({key: self.set_device(value) if torch.is_tensor(value) else value for key, value in data.items()})
         self.cond_image = self.set_device(data.get('cond_image'))
         self.gt_image = self.set_device(data.get('gt_image'))
         self.mask = self.set_device(data.get('mask'))
@@ -73,7 +161,7 @@ class Palette(BaseModel):
         if self.task in ['inpainting','uncropping']:
             dict.update({
                 'mask': self.mask.detach()[:].float().cpu(),
-                'mask_image': (self.mask_image+1)/2,
+                'mask_image': (self.mask_image.detach()[:].float().cpu()+1)/2,
             })
         if phase != 'train':
             dict.update({
@@ -88,73 +176,182 @@ class Palette(BaseModel):
             ret_path.append('GT_{}'.format(self.path[idx]))
             ret_result.append(self.gt_image[idx].detach().float().cpu())
 
-            ret_path.append('Process_{}'.format(self.path[idx]))
-            ret_result.append(self.visuals[idx::self.batch_size].detach().float().cpu())
-            
-            ret_path.append('Out_{}'.format(self.path[idx]))
-            ret_result.append(self.visuals[idx-self.batch_size].detach().float().cpu())
+            for k in range(self.num_samples):
+                ''' candidates are saved as <name>_<k> '''
+                name, ext = os.path.splitext(self.path[idx])
+                name = self.path[idx] if self.num_samples == 1 else '{}_{}{}'.format(name, k, ext)
+                sample_idx = idx*self.num_samples + k
+
+                ''' visuals is None when the network keeps no trajectory '''
+                if self.visuals is not None:
+                    ret_path.append('Process_{}'.format(name))
+                    ret_result.append(self.visuals[sample_idx::self.batch_size*self.num_samples].detach().float().cpu())
+
+                ret_path.append('Out_{}'.format(name))
+                ret_result.append(self.output[sample_idx].detach().float().cpu())
         
         if self.task in ['inpainting','uncropping']:
             ret_path.extend(['Mask_{}'.format(name) for name in self.path])
-            ret_result.extend(self.mask_image)
+            ret_result.extend(self.mask_image.detach().float().cpu())
 
         self.results_dict = self.results_dict._replace(name=ret_path, result=ret_result)
         return self.results_dict._asdict()
 
+    def update_mask_stats(self, tracker):
+        ''' masked fraction of the pixels and share of empty masks, summed on the device and averaged like the losses '''
+        if self.mask is None:
+            return
+        masked = self.mask.flatten(1).float().mean(dim=1)
+        tracker.update('mask_ratio', masked.mean(), n=len(masked))
+        tracker.update('empty_masks', (masked == 0).float().mean(), n=len(masked))
+
+    def get_loss(self):
+        ''' training loss of the current batch, can rewrite in inherited class '''
+        return self.netG(self.gt_image, self.cond_image, mask=self.mask)
+
     def train_step(self):
         self.netG.train()
         self.train_metrics.reset()
-        for train_data in tqdm.tqdm(self.phase_loader):
+        ''' gradients of accum_iter micro-batches are summed before every optimizer step, self.iter counts the samples of whole steps '''
+        accum_iter = self.opt['train']['accum_iter'] or 1
+        num_batches, step_samples = len(self.phase_loader), 0
+        self.optG.zero_grad()
+        for idx, train_data in enumerate(tqdm.tqdm(self.phase_loader)):
             self.set_input(train_data)
+            self.update_mask_stats(self.train_metrics)
+            window_start = idx - idx % accum_iter
+            window_size = min(accum_iter, num_batches - window_start)
+            last_micro_batch = idx == window_start + window_size - 1
+            ''' DDP all-reduces the gradients only on the last micro-batch of a step '''
+            sync_context = self.netG.no_sync() if self.opt['distributed'] and not last_micro_batch else contextlib.nullcontext()
+            with sync_context:
+                with torch.autocast(self.device_type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+                    loss = self.get_loss()
+                self.scaler.scale(loss / window_size).backward()
+            self.train_metrics.update(self.loss_fn.__name__, loss.detach())
+            step_samples += self.batch_size
+            if not last_micro_batch:
+                continue
+            self.scaler.step(self.optG)
+            self.scaler.update()
             self.optG.zero_grad()
-            loss = self.netG(self.gt_image, self.cond_image, mask=self.mask)
-            loss.backward()
-            self.optG.step()
 
-            self.iter += self.batch_size
+            last_iter, self.iter = self.iter, self.iter + step_samples
+            step_samples = 0
             self.writer.set_iter(self.epoch, self.iter, phase='train')
-            self.train_metrics.update(self.loss_fn.__name__, loss.item())
-            if self.iter % self.opt['train']['log_iter'] == 0:
+            ''' a step covers several iterations, an interval is due when the step crosses one of its multiples '''
+            crossed = lambda interval: self.iter // interval > last_iter // interval
+            if crossed(self.opt['train']['log_iter']):
                 for key, value in self.train_metrics.result().items():
                     self.logger.info('{:5s}: {}\t'.format(str(key), value))
                     self.writer.add_scalar(key, value)
                 for key, value in self.get_current_visuals().items():
                     self.writer.add_images(key, value)
-            if self.ema_scheduler is not None:
-                if self.iter > self.ema_scheduler['ema_start'] and self.iter % self.ema_scheduler['ema_iter'] == 0:
+            if self.ema_scheduler is not None and self.iter > self.ema_scheduler['ema_start']:
+                self.EMA.step()
+                if crossed(self.ema_scheduler['ema_iter']):
                     self.EMA.update_model_average(self.netG_EMA, self.netG)
 
         for scheduler in self.schedulers:
             scheduler.step()
         return self.train_metrics.result()
     
+    def get_training_state(self):
+        ''' the EMA update count drives the warmup of a resumed run '''
+        if self.ema_scheduler is None:
+            return {}
+        return {'ema': self.EMA.state_dict()}
+
+    def set_training_state(self, state):
+        if self.ema_scheduler is None:
+            return
+        if 'ema' in state:
+            self.EMA.load_state_dict(state['ema'])
+        else:
+            ''' training states saved without the count are assumed to be past the warmup '''
+            self.EMA.num_updates = max(self.iter - self.ema_scheduler['ema_start'], 0)
+
+    def get_network(self):
+        if self.opt['distributed']:
+            return self.netG.module
+        return self.netG
+
+    def restoration(self):
+        ''' restore num_samples candidates of the current batch into self.output, [b*num_samples] with the candidates of every input next to each other '''
+        if self.task in ['inpainting','uncropping']:
+            self.output, self.visuals = self.get_network().restoration(self.cond_image, y_t=self.cond_image, 
+                y_0=self.gt_image, mask=self.mask, sample_num=self.sample_num, num_samples=self.num_samples)
+        else:
+            self.output, self.visuals = self.get_network().restoration(self.cond_image, sample_num=self.sample_num, num_samples=self.num_samples)
+
+    def update_metrics(self, tracker):
+        ''' metrics are averaged over all candidates, with candidate_metrics every candidate is logged on its own as well '''
+        gt_image = self.gt_image.repeat_interleave(self.num_samples, dim=0)
+        for met in self.metrics:
+            key = met.__name__
+            value = met(gt_image, self.output)
+            tracker.update(key, value)
+            self.writer.add_scalar(key, value)
+            if self.candidate_metrics:
+                for k in range(self.num_samples):
+                    key = '{}_{}'.format(met.__name__, k)
+                    value = met(self.gt_image, self.output[k::self.num_samples])
+                    tracker.update(key, value)
+                    self.writer.add_scalar(key, value)
+
+    def quantize_network(self, static_convs=False, calibration_batches=4, report_delta=False):
+        ''' replace the UNet by an int8 copy, static_convs calibrates the 3x3 convs on calibration_batches batches of the test data '''
+        if self.device_type != 'cpu':
+            raise NotImplementedError('int8 quantization is only implemented for inference on CPU.')
+        network = self.get_network()
+        network.denoise_fn.eval()
+        calibrate = partial(self.calibrate, num_batches=calibration_batches)
+        quantized = quantize_unet(network.denoise_fn, static_convs=static_convs, calibrate=calibrate)
+        if report_delta:
+            self.fp32_denoise_fn = network.denoise_fn
+        network.denoise_fn = quantized
+        self.logger.info('UNet quantized to int8{}.'.format(' with static convs' if static_convs else ''))
+
+    def calibrate(self, denoise_fn, num_batches=4):
+        ''' run denoise_fn on noisy versions of the first num_batches test batches, at noise levels spread over the schedule '''
+        network = self.get_network()
+        for idx, phase_data in enumerate(self.phase_loader):
+            if idx >= num_batches:
+                break
+            self.set_input(phase_data)
+            for t in torch.linspace(0, network.num_timesteps-1, 8).long().tolist():
+                gammas = network.gammas[t].expand(self.gt_image.shape[0], 1)
+                y_noisy = network.q_sample(self.gt_image, gammas.view(-1, 1, 1, 1))
+                if self.mask is not None:
+                    y_noisy = y_noisy*self.mask + (1.-self.mask)*self.gt_image
+                denoise_fn(torch.cat([self.cond_image, y_noisy], dim=1), gammas)
+
+    def update_fp32_metrics(self, tracker):
+        ''' restore the batch with the fp32 UNet and the random numbers the quantized one is about to use '''
+        network = self.get_network()
+        rng_state = torch.get_rng_state()
+        quantized, network.denoise_fn = network.denoise_fn, self.fp32_denoise_fn
+        self.restoration()
+        network.denoise_fn = quantized
+        torch.set_rng_state(rng_state)
+
+        gt_image = self.gt_image.repeat_interleave(self.num_samples, dim=0)
+        for met in self.metrics:
+            key = '{}_fp32'.format(met.__name__)
+            value = met(gt_image, self.output)
+            tracker.update(key, value)
+            self.writer.add_scalar(key, value)
+
     def val_step(self):
         self.netG.eval()
         self.val_metrics.reset()
         with torch.no_grad():
             for val_data in tqdm.tqdm(self.val_loader):
                 self.set_input(val_data)
-                if self.opt['distributed']:
-                    if self.task in ['inpainting','uncropping']:
-                        self.output, self.visuals = self.netG.module.restoration(self.cond_image, y_t=self.cond_image, 
-                            y_0=self.gt_image, mask=self.mask, sample_num=self.sample_num)
-                    else:
-                        self.output, self.visuals = self.netG.module.restoration(self.cond_image, sample_num=self.sample_num)
-                else:
-                    if self.task in ['inpainting','uncropping']:
-                        self.output, self.visuals = self.netG.restoration(self.cond_image, y_t=self.cond_image, 
-                            y_0=self.gt_image, mask=self.mask, sample_num=self.sample_num)
-                    else:
-                        self.output, self.visuals = self.netG.restoration(self.cond_image, sample_num=self.sample_num)
-                    
+                self.restoration()
                 self.iter += self.batch_size
                 self.writer.set_iter(self.epoch, self.iter, phase='val')
-
-                for met in self.metrics:
-                    key = met.__name__
-                    value = met(self.gt_image, self.output)
-                    self.val_metrics.update(key, value)
-                    self.writer.add_scalar(key, value)
+                self.update_metrics(self.val_metrics)
                 for key, value in self.get_current_visuals(phase='val').items():
                     self.writer.add_images(key, value)
                 self.writer.save_images(self.save_current_results())
@@ -167,31 +364,22 @@ class Palette(BaseModel):
         with torch.no_grad():
             for phase_data in tqdm.tqdm(self.phase_loader):
                 self.set_input(phase_data)
-                if self.opt['distributed']:
-                    if self.task in ['inpainting','uncropping']:
-                        self.output, self.visuals = self.netG.module.restoration(self.cond_image, y_t=self.cond_image, 
-                            y_0=self.gt_image, mask=self.mask, sample_num=self.sample_num)
-                    else:
-                        self.output, self.visuals = self.netG.module.restoration(self.cond_image, sample_num=self.sample_num)
-                else:
-                    if self.task in ['inpainting','uncropping']:
-                        self.output, self.visuals = self.netG.restoration(self.cond_image, y_t=self.cond_image, 
-                            y_0=self.gt_image, mask=self.mask, sample_num=self.sample_num)
-                    else:
-                        self.output, self.visuals = self.netG.restoration(self.cond_image, sample_num=self.sample_num)
-                        
+                self.update_mask_stats(self.test_metrics)
+                if self.fp32_denoise_fn is not None:
+                    self.update_fp32_metrics(self.test_metrics)
+                self.restoration()
                 self.iter += self.batch_size
                 self.writer.set_iter(self.epoch, self.iter, phase='test')
-                for met in self.metrics:
-                    key = met.__name__
-                    value = met(self.gt_image, self.output)
-                    self.test_metrics.update(key, value)
-                    self.writer.add_scalar(key, value)
+                self.update_metrics(self.test_metrics)
                 for key, value in self.get_current_visuals(phase='test').items():
                     self.writer.add_images(key, value)
                 self.writer.save_images(self.save_current_results())
         
         test_log = self.test_metrics.result()
+        if self.fp32_denoise_fn is not None:
+            ''' accuracy change of the quantized UNet, int8 minus fp32 '''
+            test_log.update({'test/{}_delta'.format(m.__name__): test_log['test/{}'.format(m.__name__)] - test_log['test/{}_fp32'.format(m.__name__)]
+                for m in self.metrics})
         ''' save logged informations into log dict ''' 
         test_log.update({'epoch': self.epoch, 'iters': self.iter})
 
@@ -220,3 +408,97 @@ class Palette(BaseModel):
             self.save_network(network=self.netG_EMA, network_label=netG_label+'_ema')
         self.save_training_state()
 
+
+
+class PaletteDistill(Palette):
+    def __init__(self, distill_config, **kwargs):
+        ''' 
+        progressive distillation of a trained Palette network, see Network.distillation_loss.
+        every round_iter iterations the student becomes the teacher and the number of sampling steps is halved,
+        from start_steps down to min_steps. the student is saved and loaded like any other Palette network.
+        '''
+        self.distill_config = distill_config
+        super(PaletteDistill, self).__init__(**kwargs)
+
+        self.start_steps = distill_config.get('start_steps', 256)
+        self.min_steps = distill_config.get('min_steps', 8)
+        self.round_iter = distill_config['round_iter']
+        assert self.start_steps >= self.min_steps, 'start_steps must not be smaller than min_steps'
+
+        network = self.get_network()
+        self.teacher = copy.deepcopy(network)
+        self.teacher.requires_grad_(False)
+        self.teacher.eval()
+        self.load_teacher()
+
+        '''
+        the teacher is sampled with the same schedule as the distilled student at test time. the schedule buffers are
+        saved with every checkpoint, so it is set after all checkpoints are loaded, on the student, its EMA and the teacher
+        '''
+        self.set_distill_schedule(distill_config.get('schedule', 'test'))
+        assert 2 * self.start_steps <= network.num_timesteps, 'start_steps must be at most half of n_timestep'
+
+        self.distill_round = None
+        self.update_round()
+
+    def get_loss(self):
+        self.update_round()
+        return self.netG(self.gt_image, self.cond_image, mask=self.mask, teacher=self.teacher, sample_steps=self.sample_steps)
+
+    def update_round(self):
+        ''' switch to the next round when self.iter crosses a multiple of round_iter '''
+        max_round = int(math.log2(self.start_steps // self.min_steps))
+        distill_round = min(int(self.iter // self.round_iter), max_round)
+        if distill_round == self.distill_round:
+            return
+        if self.distill_round is not None:
+            ''' the student of the finished round, preferably its EMA weights, becomes the next teacher '''
+            student = self.netG_EMA if self.ema_scheduler is not None else self.netG
+            if isinstance(student, nn.parallel.DistributedDataParallel):
+                student = student.module
+            self.teacher.load_state_dict(student.state_dict())
+            self.optG.state.clear()
+        self.distill_round = distill_round
+        self.sample_steps = self.start_steps // 2**distill_round
+
+        ''' validation samples the student with the step count it is currently trained for '''
+        network = self.get_network()
+        network.sample_mode, network.sample_steps = 'ddim', self.sample_steps
+        self.logger.info('Distillation round {:d}: student with {:d} sampling steps.'.format(self.distill_round, self.sample_steps))
+
+    def load_teacher(self):
+        ''' load the teacher saved with a resumed run, otherwise the trained network the distillation starts from '''
+        netG_label = self.get_network().__class__.__name__
+        teacher_path = None
+        if self.opt['path']['resume_state'] is not None:
+            teacher_path = '{}_{}_teacher.pth'.format(self.opt['path']['resume_state'], netG_label)
+        if teacher_path is None or not os.path.exists(teacher_path):
+            teacher_state = self.distill_config['teacher_state']
+            teacher_path = '{}_{}_ema.pth'.format(teacher_state, netG_label)
+            if not os.path.exists(teacher_path):
+                teacher_path = '{}_{}.pth'.format(teacher_state, netG_label)
+            ''' a new distillation starts with the student initialized from the teacher '''
+            if self.opt['path']['resume_state'] is None:
+                self.load_network_from(self.netG, teacher_path)
+                if self.ema_scheduler is not None:
+                    self.load_network_from(self.netG_EMA, teacher_path)
+        self.load_network_from(self.teacher, teacher_path)
+
+    def set_distill_schedule(self, phase):
+        networks = [self.get_network(), self.teacher]
+        if self.ema_scheduler is not None:
+            networks.append(self.netG_EMA)
+        for network in networks:
+            if isinstance(network, nn.parallel.DistributedDataParallel):
+                network = network.module
+            network.set_new_noise_schedule(phase=phase)
+
+    def load_network_from(self, network, model_path):
+        self.logger.info('Loading pretrained model from [{:s}] ...'.format(model_path))
+        if isinstance(network, nn.DataParallel) or isinstance(network, nn.parallel.DistributedDataParallel):
+            network = network.module
+        network.load_state_dict(torch.load(model_path, map_location = lambda storage, loc: self.set_device(storage)), strict=False)
+
+    def save_everything(self):
+        super(PaletteDistill, self).save_everything()
+        self.save_network(network=self.teacher, network_label=self.get_network().__class__.__name__+'_teacher')
@@ -1,12 +1,16 @@
 import math
+import os
 import torch
+import torch.nn.functional as F
 from inspect import isfunction
 from functools import partial
+from types import SimpleNamespace
 import numpy as np
 from tqdm import tqdm
 from core.base_network import BaseNetwork
+from .runtime import noise_schedule_coefficients, space_timesteps, respaced_betas
 class Network(BaseNetwork):
-    def __init__(self, unet, beta_schedule, module_name='sr3', **kwargs):
+    def __init__(self, unet, beta_schedule, module_name='sr3', sample_config={}, **kwargs):
         super(Network, self).__init__(**kwargs)
         if module_name == 'sr3':
             from .sr3_modules.unet import UNet
@@ -15,59 +19,132 @@ class Network(BaseNetwork):
         
         self.denoise_fn = UNet(**unet)
         self.beta_schedule = beta_schedule
+        # spatial sizes fed to the UNet must be multiples of this
+        self.downsample_factor = 2**(len(unet.get('channel_mults', (1, 2, 4, 8)))-1)
+
+        ''' sample_mode: ddpm (ancestral, every timestep) | ddim (deterministic when ddim_eta is 0, strided) 
+            | dpm_solver (DPM-Solver++(2M), sample_steps is the number of network evaluations) '''
+        self.sample_mode = sample_config.get('sample_mode', 'ddpm')
+        self.sample_steps = sample_config.get('sample_steps', None)
+        self.ddim_eta = sample_config.get('ddim_eta', 0.)
+        ''' when roi_margin is set, only the bounding box of the mask plus roi_margin pixels of context is sampled '''
+        self.roi_margin = sample_config.get('roi_margin', None)
+        ''' images larger than tile_size are sampled in overlapping tiles, tile_batch tiles per UNet call '''
+        self.tile_size = sample_config.get('tile_size', None)
+        self.tile_overlap = sample_config.get('tile_overlap', (self.tile_size or 0) // 4)
+        self.tile_batch = sample_config.get('tile_batch', 4)
+        ''' trajectory returned by restoration: final (only the output, no trajectory) | snapshots (sample_num intermediate results) '''
+        self.trajectory = sample_config.get('trajectory', 'final')
+        if self.trajectory not in ['snapshots', 'final']:
+            raise NotImplementedError('Trajectory {} has not been implemented.'.format(self.trajectory))
+        if self.sample_mode not in ['ddpm', 'ddim', 'dpm_solver']:
+            raise NotImplementedError('Sample mode {} has not been implemented.'.format(self.sample_mode))
+        self.amp_dtype = None
+        ''' compile_mode: torch.compile mode of the UNet for sampling, e.g. reduce-overhead (captures CUDA graphs). 
+            it is compiled on first use and once per input shape, compile_cache_dir keeps the compiled kernels across runs '''
+        self.compile_mode = sample_config.get('compile_mode', None)
+        self.compile_cache_dir = sample_config.get('compile_cache_dir', None)
+        self.compiled_fn = {}
 
     def set_loss(self, loss_fn):
         self.loss_fn = loss_fn
 
-    def set_new_noise_schedule(self, device=torch.device('cuda'), phase='train'):
+    def set_amp(self, amp_dtype=None):
+        ''' sampling runs the UNet under autocast with amp_dtype, None disables it '''
+        self.amp_dtype = amp_dtype
+
+    def set_new_noise_schedule(self, device=None, phase='train'):
+        ''' buffers are created on device, by default the device of the UNet '''
+        device = default(device, lambda: next(self.denoise_fn.parameters()).device)
         to_torch = partial(torch.tensor, dtype=torch.float32, device=device)
         betas = make_beta_schedule(**self.beta_schedule[phase])
         betas = betas.detach().cpu().numpy() if isinstance(
             betas, torch.Tensor) else betas
-        alphas = 1. - betas
 
         timesteps, = betas.shape
         self.num_timesteps = int(timesteps)
-        
-        gammas = np.cumprod(alphas, axis=0)
-        gammas_prev = np.append(1., gammas[:-1])
-
-        # calculations for diffusion q(x_t | x_{t-1}) and others
-        self.register_buffer('gammas', to_torch(gammas))
-        self.register_buffer('sqrt_recip_gammas', to_torch(np.sqrt(1. / gammas)))
-        self.register_buffer('sqrt_recipm1_gammas', to_torch(np.sqrt(1. / gammas - 1)))
-
-        # calculations for posterior q(x_{t-1} | x_t, x_0)
-        posterior_variance = betas * (1. - gammas_prev) / (1. - gammas)
-        # below: log calculation clipped because the posterior variance is 0 at the beginning of the diffusion chain
-        self.register_buffer('posterior_log_variance_clipped', to_torch(np.log(np.maximum(posterior_variance, 1e-20))))
-        self.register_buffer('posterior_mean_coef1', to_torch(betas * np.sqrt(gammas_prev) / (1. - gammas)))
-        self.register_buffer('posterior_mean_coef2', to_torch((1. - gammas_prev) * np.sqrt(alphas) / (1. - gammas)))
-
-    def predict_start_from_noise(self, y_t, t, noise):
+
+        for key, value in noise_schedule_coefficients(betas).items():
+            self.register_buffer(key, to_torch(value))
+
+        ''' respaced schedules are derived from the float64 gammas and cached per number of steps '''
+        self.schedule_gammas = np.cumprod(1. - betas, axis=0)
+        self.respaced_schedules = {}
+        if self.sample_mode == 'ddpm' and self.sample_steps is not None:
+            self.respace(self.sample_steps)
+
+    def respace(self, sample_steps):
+        """
+        schedule of sample_steps timesteps picked from the current one by space_timesteps. 
+        betas are recomputed between the kept timesteps, so ancestral sampling over it is still a DDPM with the same gammas.
+        """
+        if sample_steps not in self.respaced_schedules:
+            timesteps = space_timesteps(self.num_timesteps, sample_steps)
+            betas = respaced_betas(self.schedule_gammas, timesteps)
+
+            to_torch = partial(torch.tensor, dtype=torch.float32, device=self.gammas.device)
+            schedule = {key: to_torch(value) for key, value in noise_schedule_coefficients(betas).items()}
+            schedule['timesteps'] = torch.tensor(timesteps, dtype=torch.long, device=self.gammas.device)
+            schedule['num_timesteps'] = sample_steps
+            self.respaced_schedules[sample_steps] = SimpleNamespace(**schedule)
+        return self.respaced_schedules[sample_steps]
+
+    def predict_start_from_noise(self, y_t, t, noise, schedule=None):
+        schedule = default(schedule, self)
         return (
-            extract(self.sqrt_recip_gammas, t, y_t.shape) * y_t -
-            extract(self.sqrt_recipm1_gammas, t, y_t.shape) * noise
+            extract(schedule.sqrt_recip_gammas, t, y_t.shape) * y_t -
+            extract(schedule.sqrt_recipm1_gammas, t, y_t.shape) * noise
         )
 
-    def q_posterior(self, y_0_hat, y_t, t):
+    def q_posterior(self, y_0_hat, y_t, t, schedule=None):
+        schedule = default(schedule, self)
         posterior_mean = (
-            extract(self.posterior_mean_coef1, t, y_t.shape) * y_0_hat +
-            extract(self.posterior_mean_coef2, t, y_t.shape) * y_t
+            extract(schedule.posterior_mean_coef1, t, y_t.shape) * y_0_hat +
+            extract(schedule.posterior_mean_coef2, t, y_t.shape) * y_t
         )
-        posterior_log_variance_clipped = extract(self.posterior_log_variance_clipped, t, y_t.shape)
+        posterior_log_variance_clipped = extract(schedule.posterior_log_variance_clipped, t, y_t.shape)
         return posterior_mean, posterior_log_variance_clipped
 
-    def p_mean_variance(self, y_t, t, clip_denoised: bool, y_cond=None):
-        noise_level = extract(self.gammas, t, x_shape=(1, 1)).to(y_t.device)
+    def sampling_denoise_fn(self):
+        ''' the UNet called by the samplers, compiled when compile_mode is set and no gradients are needed '''
+        if self.compile_mode is None or torch.is_grad_enabled():
+            return self.denoise_fn
+        # keyed by the UNet, denoise_fn may be swapped (e.g. for a quantized copy)
+        key = id(self.denoise_fn)
+        if key not in self.compiled_fn:
+            if self.compile_cache_dir is not None:
+                os.environ['TORCHINDUCTOR_CACHE_DIR'] = self.compile_cache_dir
+            self.compiled_fn[key] = torch.compile(self.denoise_fn, mode=self.compile_mode, dynamic=False)
+        compiled_fn = self.compiled_fn[key]
+
+        def denoise_fn(*args):
+            # outputs of CUDA graphs are overwritten by the next replay, so every call (e.g. per tile) starts a new step 
+            # and its output has to be used before the next call
+            torch.compiler.cudagraph_mark_step_begin()
+            return compiled_fn(*args)
+        return denoise_fn
+
+    def predict_noise(self, y_cond, y_t, noise_level, tiles=None):
+        ''' only the UNet runs in amp_dtype, y_t and the sampler updates are accumulated in float32 '''
+        denoise_fn = self.sampling_denoise_fn()
+        with torch.autocast(y_t.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+            if tiles is not None:
+                noise = tiles.denoise(denoise_fn, y_cond, y_t, noise_level)
+            else:
+                noise = denoise_fn(torch.cat([y_cond, y_t], dim=1), noise_level)
+        return noise.float()
+
+    def p_mean_variance(self, y_t, t, clip_denoised: bool, y_cond=None, schedule=None, tiles=None):
+        schedule = default(schedule, self)
+        noise_level = extract(schedule.gammas, t, x_shape=(1, 1)).to(y_t.device)
         y_0_hat = self.predict_start_from_noise(
-                y_t, t=t, noise=self.denoise_fn(torch.cat([y_cond, y_t], dim=1), noise_level))
+                y_t, t=t, noise=self.predict_noise(y_cond, y_t, noise_level, tiles=tiles), schedule=schedule)
 
         if clip_denoised:
             y_0_hat.clamp_(-1., 1.)
 
         model_mean, posterior_log_variance = self.q_posterior(
-            y_0_hat=y_0_hat, y_t=y_t, t=t)
+            y_0_hat=y_0_hat, y_t=y_t, t=t, schedule=schedule)
         return model_mean, posterior_log_variance
 
     def q_sample(self, y_0, sample_gammas, noise=None):
@@ -78,31 +155,177 @@ class Network(BaseNetwork):
         )
 
     @torch.no_grad()
-    def p_sample(self, y_t, t, clip_denoised=True, y_cond=None):
+    def p_sample(self, y_t, t, clip_denoised=True, y_cond=None, schedule=None, tiles=None):
         model_mean, model_log_variance = self.p_mean_variance(
-            y_t=y_t, t=t, clip_denoised=clip_denoised, y_cond=y_cond)
+            y_t=y_t, t=t, clip_denoised=clip_denoised, y_cond=y_cond, schedule=schedule, tiles=tiles)
         noise = torch.randn_like(y_t) if any(t>0) else torch.zeros_like(y_t)
         return model_mean + noise * (0.5 * model_log_variance).exp()
 
+    def gammas_at(self, t, x_shape=(1,1,1,1)):
+        """ like extract(self.gammas, t, x_shape), but t < 0 means y_0 itself, whose gamma is 1 """
+        gammas = torch.where(t >= 0, self.gammas.gather(-1, t.clamp(min=0)), torch.ones_like(t, dtype=self.gammas.dtype))
+        return gammas.reshape(-1, *((1,) * (len(x_shape) - 1)))
+
+    @torch.no_grad()
+    def ddim_sample(self, y_t, t, t_prev, clip_denoised=True, y_cond=None, eta=0., tiles=None):
+        noise_level = extract(self.gammas, t, x_shape=(1, 1)).to(y_t.device)
+        noise = self.predict_noise(y_cond, y_t, noise_level, tiles=tiles)
+        y_0_hat = self.predict_start_from_noise(y_t, t=t, noise=noise)
+
+        if clip_denoised:
+            y_0_hat.clamp_(-1., 1.)
+            # re-derive the noise so that the update stays consistent with the clipped y_0_hat
+            noise = (extract(self.sqrt_recip_gammas, t, y_t.shape) * y_t - y_0_hat) / extract(self.sqrt_recipm1_gammas, t, y_t.shape)
+
+        gamma_t = extract(self.gammas, t, y_t.shape)
+        gamma_prev = self.gammas_at(t_prev, y_t.shape)
+
+        sigma = eta * ((1 - gamma_prev) / (1 - gamma_t) * (1 - gamma_t / gamma_prev)).sqrt()
+        y_prev = gamma_prev.sqrt() * y_0_hat + (1 - gamma_prev - sigma ** 2).clamp(min=0).sqrt() * noise
+        if eta > 0 and any(t_prev >= 0):
+            y_prev = y_prev + sigma * torch.randn_like(y_t)
+        return y_prev
+
+    @torch.no_grad()
+    def dpm_solver_sample(self, y_t, t, t_prev, clip_denoised=True, y_cond=None, y_0_last=None, t_last=None, tiles=None):
+        """ 
+        one DPM-Solver++(2M) step from t to t_prev, y_0_last is the data prediction made at the previous step t_last. 
+        returns the new state and the data prediction at t, which is reused by the next step.
+        """
+        noise_level = extract(self.gammas, t, x_shape=(1, 1)).to(y_t.device)
+        y_0_hat = self.predict_start_from_noise(
+                y_t, t=t, noise=self.predict_noise(y_cond, y_t, noise_level, tiles=tiles))
+        if clip_denoised:
+            y_0_hat.clamp_(-1., 1.)
+
+        # the last step lands on y_0, where sigma is 0 and lambda is infinite
+        if not any(t_prev >= 0):
+            return y_0_hat, y_0_hat
+
+        gamma_t = extract(self.gammas, t, y_t.shape)
+        gamma_prev = extract(self.gammas, t_prev, y_t.shape)
+        lambda_t, lambda_prev = half_log_snr(gamma_t), half_log_snr(gamma_prev)
+        h = lambda_prev - lambda_t
+
+        data_pred = y_0_hat
+        if y_0_last is not None:
+            r = (lambda_t - half_log_snr(extract(self.gammas, t_last, y_t.shape))) / h
+            data_pred = (1. + 0.5 / r) * y_0_hat - (0.5 / r) * y_0_last
+
+        y_prev = ((1 - gamma_prev) / (1 - gamma_t)).sqrt() * y_t - gamma_prev.sqrt() * torch.expm1(-h) * data_pred
+        return y_prev, y_0_hat
+
+    def sample_timesteps(self, sample_steps):
+        """ timesteps visited by restoration, from the noisiest to the cleanest one """
+        if self.sample_mode == 'ddpm':
+            # ddpm walks every timestep of the (respaced) schedule, indices are local to that schedule
+            return np.arange(sample_steps)[::-1]
+        return space_timesteps(self.num_timesteps, sample_steps)[::-1]
+
+    @torch.no_grad()
+    def restoration(self, y_cond, y_t=None, y_0=None, mask=None, sample_num=8, sample_steps=None, num_samples=1):
+        """
+        num_samples > 1 draws several candidates per input in the same UNet calls, the outputs are laid out
+        as [b*num_samples] with the candidates of every input next to each other.
+        """
+        if num_samples > 1:
+            y_cond, y_t, y_0, mask = [None if x is None else x.repeat_interleave(num_samples, dim=0) for x in (y_cond, y_t, y_0, mask)]
+            if y_t is not None:
+                ''' every candidate starts from its own noise, the first one keeps the given y_t '''
+                noise = torch.randn_like(y_t)
+                noise[::num_samples] = y_t[::num_samples]
+                y_t = noise if mask is None else y_t*(1.-mask) + mask*noise
+        if self.roi_margin is not None and mask is not None:
+            return self.roi_restoration(y_cond, y_t=y_t, y_0=y_0, mask=mask, sample_num=sample_num, sample_steps=sample_steps, group=num_samples)
+        return self.sample_loop(y_cond, y_t=y_t, y_0=y_0, mask=mask, sample_num=sample_num, sample_steps=sample_steps)
+
     @torch.no_grad()
-    def restoration(self, y_cond, y_t=None, y_0=None, mask=None, sample_num=8):
+    def roi_restoration(self, y_cond, y_t=None, y_0=None, mask=None, sample_num=8, sample_steps=None, group=1):
+        """
+        sample only the bounding box of every mask, expanded by roi_margin pixels and snapped to the downsampling 
+        factor of the UNet, then paste the crops back into the known pixels. samples without masked pixels are not sampled.
+        every run of `group` consecutive samples shares one mask (the candidates of one input) and is sampled together.
+        the crops of different inputs differ in size, so the inputs of a batch are sampled one after another.
+        """
+        y_t = default(y_t, lambda: torch.randn_like(y_cond))
+        outputs, ret_arrs = [], []
+        for idx in range(0, y_cond.shape[0], group):
+            part = slice(idx, idx+group)
+            output, ret_arr = y_0[part].clone(), None
+            bbox = mask_bbox(mask[idx], self.roi_margin, self.downsample_factor)
+            if bbox is not None:
+                top, left, height, width = bbox
+                crop = (Ellipsis, slice(top, top+height), slice(left, left+width))
+                crop_output, crop_ret_arr = self.sample_loop(y_cond[part][crop], y_t=y_t[part][crop], 
+                    y_0=y_0[part][crop], mask=mask[part][crop], sample_num=sample_num, sample_steps=sample_steps)
+                output[crop] = crop_output
+                if self.trajectory == 'snapshots':
+                    ''' outside of the crop every intermediate result equals y_0, except for the initial y_t '''
+                    ret_arr = y_0[part].repeat(crop_ret_arr.shape[0]//group, 1, 1, 1)
+                    ret_arr[crop] = crop_ret_arr
+                    ret_arr[:group] = y_t[part]
+            outputs.append(output)
+            ret_arrs.append(ret_arr)
+
+        output = torch.cat(outputs, dim=0)
+        if self.trajectory != 'snapshots':
+            return output, None
+        ''' samples without masked pixels have a trajectory of y_0 only, with the same length as the others '''
+        num_frames = max([r.shape[0]//group for r in ret_arrs if r is not None], default=1)
+        ret_arrs = [r if r is not None else torch.cat([y_t[idx*group:(idx+1)*group], y_0[idx*group:(idx+1)*group].repeat(num_frames-1, 1, 1, 1)], dim=0) 
+            for idx, r in enumerate(ret_arrs)]
+        # same layout as sample_loop: all samples of the first frame, then all samples of the second frame, ...
+        ret_arr = torch.cat([r.unflatten(0, (num_frames, group)) for r in ret_arrs], dim=1).flatten(0, 1)
+        return output, ret_arr
+
+    @torch.no_grad()
+    def sample_loop(self, y_cond, y_t=None, y_0=None, mask=None, sample_num=8, sample_steps=None):
         b, *_ = y_cond.shape
 
-        assert self.num_timesteps > sample_num, 'num_timesteps must greater than sample_num'
-        sample_inter = (self.num_timesteps//sample_num)
+        sample_steps = default(sample_steps, default(self.sample_steps, self.num_timesteps))
+        schedule = None
+        if self.sample_mode == 'ddpm' and sample_steps != self.num_timesteps:
+            schedule = self.respace(sample_steps)
+        timesteps = self.sample_timesteps(sample_steps)
+        num_steps = len(timesteps)
+        # distilled or strided samplers may take fewer steps than sample_num, then every step is kept
+        sample_inter = max(num_steps//sample_num, 1)
         
         y_t = default(y_t, lambda: torch.randn_like(y_cond))
-        ret_arr = y_t
-        for i in tqdm(reversed(range(0, self.num_timesteps)), desc='sampling loop time step', total=self.num_timesteps):
+        tiles = None
+        if self.tile_size is not None and max(y_cond.shape[-2:]) > self.tile_size:
+            tiles = Tiles(y_cond.shape, self.tile_size, self.tile_overlap, tile_batch=self.tile_batch, mask=mask, device=y_cond.device, 
+                multiple=self.downsample_factor)
+        ret_arr = None
+        if self.trajectory == 'snapshots':
+            ''' the initial y_t and every sample_inter-th step, written into one preallocated buffer '''
+            num_frames = (num_steps-1)//sample_inter + 2
+            ret_arr = y_t.new_empty((num_frames * b, *y_t.shape[1:]))
+            ret_arr[:b] = y_t
+            frame = 1
+        y_0_last, t_last = None, None
+        for idx, i in enumerate(tqdm(timesteps, desc='sampling loop time step', total=num_steps)):
             t = torch.full((b,), i, device=y_cond.device, dtype=torch.long)
-            y_t = self.p_sample(y_t, t, y_cond=y_cond)
+            i_prev = timesteps[idx+1] if idx+1 < num_steps else -1
+            t_prev = torch.full((b,), i_prev, device=y_cond.device, dtype=torch.long)
+            if self.sample_mode == 'ddim':
+                y_t = self.ddim_sample(y_t, t, t_prev, y_cond=y_cond, eta=self.ddim_eta, tiles=tiles)
+            elif self.sample_mode == 'dpm_solver':
+                y_t, y_0_last = self.dpm_solver_sample(y_t, t, t_prev, y_cond=y_cond, y_0_last=y_0_last, t_last=t_last, tiles=tiles)
+                t_last = t
+            else:
+                y_t = self.p_sample(y_t, t, y_cond=y_cond, schedule=schedule, tiles=tiles)
             if mask is not None:
                 y_t = y_0*(1.-mask) + mask*y_t
-            if i % sample_inter == 0:
-                ret_arr = torch.cat([ret_arr, y_t], dim=0)
+            if ret_arr is not None and (num_steps-1-idx) % sample_inter == 0:
+                ret_arr[frame*b:(frame+1)*b] = y_t
+                frame += 1
         return y_t, ret_arr
 
-    def forward(self, y_0, y_cond=None, mask=None, noise=None):
+    def forward(self, y_0, y_cond=None, mask=None, noise=None, teacher=None, sample_steps=None):
+        if teacher is not None:
+            return self.distillation_loss(teacher, y_0, y_cond=y_cond, mask=mask, noise=noise, sample_steps=sample_steps)
+
         # sampling from p(gammas)
         b, *_ = y_0.shape
         t = torch.randint(1, self.num_timesteps, (b,), device=y_0.device).long()
@@ -123,6 +346,93 @@ class Network(BaseNetwork):
             loss = self.loss_fn(noise, noise_hat)
         return loss
 
+    def distillation_loss(self, teacher, y_0, y_cond=None, mask=None, noise=None, sample_steps=8):
+        """
+        progressive distillation (Salimans & Ho, 2022): one DDIM step of this network on the grid of sample_steps
+        timesteps has to land where two DDIM steps of the teacher on the grid of 2*sample_steps timesteps land.
+        both grids come from space_timesteps, so the student is later sampled with sample_mode ddim and the same sample_steps.
+        """
+        b, *_ = y_0.shape
+        grid = torch.as_tensor(space_timesteps(self.num_timesteps, 2*sample_steps), device=y_0.device)
+        j = torch.randint(0, sample_steps, (b,), device=y_0.device)
+        t, t_mid = grid[2*j+1], grid[2*j]
+        t_prev = torch.where(j > 0, grid[(2*j-1).clamp(min=0)], torch.full_like(j, -1))
+        gamma_t, gamma_mid, gamma_prev = [self.gammas_at(s, y_0.shape) for s in (t, t_mid, t_prev)]
+
+        noise = default(noise, lambda: torch.randn_like(y_0))
+        y_t = self.q_sample(y_0=y_0, sample_gammas=gamma_t, noise=noise)
+        if mask is not None:
+            y_t = y_t*mask + (1.-mask)*y_0
+
+        def teacher_step(y, gamma, gamma_next):
+            noise_hat = teacher.denoise_fn(torch.cat([y_cond, y], dim=1), gamma.view(b, -1))
+            y_0_hat = ((y - (1 - gamma).sqrt() * noise_hat) / gamma.sqrt()).clamp(-1., 1.)
+            noise_hat = (y - gamma.sqrt() * y_0_hat) / (1 - gamma).sqrt()
+            y_next = gamma_next.sqrt() * y_0_hat + (1 - gamma_next).sqrt() * noise_hat
+            if mask is not None:
+                y_next = y_0*(1.-mask) + mask*y_next
+            return y_next
+
+        with torch.no_grad():
+            y_prev = teacher_step(teacher_step(y_t, gamma_t, gamma_mid), gamma_mid, gamma_prev)
+            # the single DDIM step from y_t that reaches y_prev, expressed as the noise the student has to predict
+            ratio = ((1 - gamma_prev) / (1 - gamma_t)).sqrt()
+            y_0_target = (y_prev - ratio * y_t) / (gamma_prev.sqrt() - ratio * gamma_t.sqrt())
+            noise_target = (y_t - gamma_t.sqrt() * y_0_target) / (1 - gamma_t).sqrt()
+
+        noise_hat = self.denoise_fn(torch.cat([y_cond, y_t], dim=1), gamma_t.view(b, -1))
+        if mask is not None:
+            return self.loss_fn(mask*noise_target, mask*noise_hat)
+        return self.loss_fn(noise_target, noise_hat)
+
+
+class Tiles():
+    """
+    overlapping tiles of a [B x C x H x W] batch for sampling images larger than the trained image_size.
+    the noise predicted on every tile is blended with a feathered window, so each step sees one consistent prediction 
+    across the seams. tiles without masked pixels are skipped, their pixels are replaced by y_0 anyway.
+    tile sides are multiples of the downsampling factor of the UNet (multiple), an image side shorter than one multiple 
+    is padded to it.
+    """
+    def __init__(self, shape, tile_size, overlap, tile_batch=4, mask=None, device=None, multiple=1):
+        b, _, h, w = shape
+        self.tile_batch = tile_batch
+        self.tile_h, self.tile_w = [max(min(tile_size, size) // multiple, 1) * multiple for size in (h, w)]
+        self.height, self.width = max(h, self.tile_h), max(w, self.tile_w)
+        self.tiles = []
+        for idx in range(b):
+            for top in tile_starts(self.height, self.tile_h, overlap):
+                for left in tile_starts(self.width, self.tile_w, overlap):
+                    if mask is None or mask[idx, :, top:top+self.tile_h, left:left+self.tile_w].any():
+                        self.tiles.append((idx, top, left))
+
+        ''' the window decays linearly over the overlap, but stays positive at the borders of the image '''
+        window_h = feather_window(self.tile_h, overlap, device)
+        window_w = feather_window(self.tile_w, overlap, device)
+        self.window = (window_h[:, None] * window_w[None, :])[None, None]
+        self.weights = torch.zeros((b, 1, self.height, self.width), device=device)
+        for idx, top, left in self.tiles:
+            self.weights[idx:idx+1, :, top:top+self.tile_h, left:left+self.tile_w] += self.window
+
+    def crop(self, tile):
+        idx, top, left = tile
+        return (slice(idx, idx+1), slice(None), slice(top, top+self.tile_h), slice(left, left+self.tile_w))
+
+    def denoise(self, denoise_fn, y_cond, y_t, noise_level):
+        y = torch.cat([y_cond, y_t], dim=1)
+        h, w = y.shape[-2:]
+        if (h, w) != (self.height, self.width):
+            y = F.pad(y, (0, self.width-w, 0, self.height-h), mode='replicate')
+        noise_level = noise_level.view(y.shape[0], -1)
+        noise = y_t.new_zeros((*y_t.shape[:2], self.height, self.width))
+        for start in range(0, len(self.tiles), self.tile_batch):
+            tiles = self.tiles[start:start+self.tile_batch]
+            index = torch.tensor([tile[0] for tile in tiles], device=y.device)
+            noise_hat = denoise_fn(torch.cat([y[self.crop(tile)] for tile in tiles], dim=0), noise_level[index])
+            for tile, tile_noise in zip(tiles, noise_hat.split(1, dim=0)):
+                noise[self.crop(tile)] += tile_noise * self.window
+        return (noise / self.weights.clamp(min=1e-8))[..., :h, :w]
+
 
 # gaussian diffusion trainer class
 def exists(x):
@@ -138,6 +448,42 @@ def extract(a, t, x_shape=(1,1,1,1)):
     out = a.gather(-1, t)
     return out.reshape(b, *((1,) * (len(x_shape) - 1)))
 
+def half_log_snr(gammas):
+    """ lambda = log(alpha/sigma) of the DPM-Solver papers, where alpha^2 = gamma and sigma^2 = 1 - gamma """
+    return 0.5 * (torch.log(gammas) - torch.log1p(-gammas))
+
+def tile_starts(length, tile_size, overlap):
+    """ start offsets of tiles of tile_size covering length, neighbouring tiles overlap by at least overlap pixels """
+    if length <= tile_size:
+        return [0]
+    stride = max(tile_size - overlap, 1)
+    starts = list(range(0, length - tile_size, stride))
+    return starts + [length - tile_size]
+
+def feather_window(tile_size, overlap, device=None):
+    """ 1-D blending weights, rising linearly over the first and falling over the last overlap pixels """
+    ramp = torch.arange(tile_size, dtype=torch.float32, device=device)
+    ramp = torch.minimum(ramp + 1, tile_size - ramp) / (overlap + 1)
+    return ramp.clamp(max=1.)
+
+def mask_bbox(mask, margin=0, multiple=1):
+    """
+    bounding box (top, left, height, width) of the nonzero pixels of a [C x H x W] mask, expanded by margin
+    and grown to multiples of multiple while staying inside the image. None if the mask is empty.
+    """
+    _, h, w = mask.shape
+    ys, xs = torch.nonzero(mask.sum(dim=0), as_tuple=True)
+    if len(ys) == 0:
+        return None
+    box = []
+    for low, high, size in [(ys.min().item(), ys.max().item()+1, h), (xs.min().item(), xs.max().item()+1, w)]:
+        low, high = max(low-margin, 0), min(high+margin, size)
+        length = min(-(-(high-low) // multiple) * multiple, size)
+        high = min(low+length, size)
+        box.append((high-length, length))
+    (top, height), (left, width) = box
+    return top, left, height, width
+
 # beta_schedule function
 def _warmup_beta(linear_start, linear_end, n_timestep, warmup_frac):
     betas = linear_end * np.ones(n_timestep, dtype=np.float64)
@@ -0,0 +1,62 @@
+"""
+int8 copies of the UNet for inference on CPU.
+"""
+import copy
+import torch
+import torch.nn as nn
+import torch.ao.quantization as tq
+
+
+class PointwiseConv1d(nn.Module):
+    ''' a 1x1 Conv1d (qkv and proj_out of the attention blocks) evaluated as nn.Linear over the channels, so that dynamic quantization applies to it '''
+    def __init__(self, conv):
+        super().__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        self.linear.weight.data.copy_(conv.weight.data[..., 0])
+        if conv.bias is not None:
+            self.linear.bias.data.copy_(conv.bias.data)
+
+    def forward(self, x):
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+class StaticQuantConv2d(nn.Module):
+    ''' a conv between quant/dequant stubs, which becomes a static int8 conv after calibration '''
+    def __init__(self, conv, qconfig):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+        self.qconfig = qconfig
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def replace_modules(module, condition, wrap):
+    for name, child in module.named_children():
+        if condition(child):
+            setattr(module, name, wrap(child))
+        else:
+            replace_modules(child, condition, wrap)
+    return module
+
+
+def quantize_unet(unet, static_convs=False, calibrate=None, backend='x86'):
+    """
+    int8 copy of unet, the original is left untouched. nn.Linear layers (embeddings) and 1x1 Conv1d layers use dynamic
+    quantization. with static_convs the 3x3 convs are quantized statically, calibrate(unet) then has to run a few forward
+    passes through the prepared copy so that the ranges of their activations are observed.
+    """
+    torch.backends.quantized.engine = backend
+    unet = copy.deepcopy(unet).cpu().eval()
+    replace_modules(unet, lambda m: isinstance(m, nn.Conv1d) and m.kernel_size == (1,), PointwiseConv1d)
+    if static_convs:
+        assert calibrate is not None, 'static quantization of the convs needs a calibration function'
+        qconfig = tq.get_default_qconfig(backend)
+        replace_modules(unet, lambda m: isinstance(m, nn.Conv2d) and m.kernel_size == (3, 3), lambda m: StaticQuantConv2d(m, qconfig))
+        tq.prepare(unet, inplace=True)
+        with torch.no_grad():
+            calibrate(unet)
+        tq.convert(unet, inplace=True)
+    return tq.quantize_dynamic(unet, {nn.Linear}, dtype=torch.qint8, inplace=True)
@@ -0,0 +1,150 @@
+"""
+numpy sampler for a UNet exported by export.py, it needs neither the training code nor its dependencies.
+the schedule helpers are shared with models/network.py, so both samplers use the same buffers.
+"""
+import numpy as np
+
+
+def noise_schedule_coefficients(betas):
+    """ buffers of the forward process and of the posterior q(x_{t-1} | x_t, x_0) for given betas """
+    alphas = 1. - betas
+    gammas = np.cumprod(alphas, axis=0)
+    gammas_prev = np.append(1., gammas[:-1])
+
+    posterior_variance = betas * (1. - gammas_prev) / (1. - gammas)
+    return {
+        # calculations for diffusion q(x_t | x_{t-1}) and others
+        'gammas': gammas,
+        'sqrt_recip_gammas': np.sqrt(1. / gammas),
+        'sqrt_recipm1_gammas': np.sqrt(1. / gammas - 1),
+        # calculations for posterior q(x_{t-1} | x_t, x_0)
+        # below: log calculation clipped because the posterior variance is 0 at the beginning of the diffusion chain
+        'posterior_log_variance_clipped': np.log(np.maximum(posterior_variance, 1e-20)),
+        'posterior_mean_coef1': betas * np.sqrt(gammas_prev) / (1. - gammas),
+        'posterior_mean_coef2': (1. - gammas_prev) * np.sqrt(alphas) / (1. - gammas),
+    }
+
+def space_timesteps(num_timesteps, sample_steps):
+    """
+    evenly spaced subsequence of sample_steps timesteps in ascending order, the last one is always num_timesteps-1.
+    subsequences of K and 2K steps are nested, e.g. space_timesteps(1000, 4) = [249, 499, 749, 999].
+    """
+    assert 0 < sample_steps <= num_timesteps, 'sample_steps must be in (0, num_timesteps]'
+    steps = np.round(np.arange(1, sample_steps+1) * num_timesteps / sample_steps).astype(np.int64) - 1
+    return steps
+
+def respaced_betas(schedule_gammas, timesteps):
+    """ betas between the kept timesteps, ancestral sampling over them is a DDPM with the same gammas """
+    gammas = schedule_gammas[timesteps]
+    return 1. - gammas / np.append(1., gammas[:-1])
+
+def half_log_snr(gammas):
+    """ lambda = log(alpha/sigma) of the DPM-Solver papers, numpy version of the one in models/network.py """
+    return 0.5 * (np.log(gammas) - np.log1p(-gammas))
+
+
+def load_denoise_fn(model_path):
+    """ denoise_fn(x, gammas) -> noise on float32 numpy arrays, from an .onnx (onnxruntime) or a TorchScript file """
+    if model_path.endswith('.onnx'):
+        import onnxruntime
+        session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        return lambda x, gammas: session.run(None, {'x': x, 'gammas': gammas})[0]
+    import torch
+    module = torch.jit.load(model_path, map_location='cpu').eval()
+    def denoise_fn(x, gammas):
+        with torch.no_grad():
+            return module(torch.from_numpy(x), torch.from_numpy(gammas)).numpy()
+    return denoise_fn
+
+
+class Sampler():
+    """
+    ddpm | ddim | dpm_solver sampling with an exported UNet, following Network.restoration without tiling, roi or trajectories.
+    arrays are float32 [b, c, h, w] in [-1, 1].
+    """
+    def __init__(self, model_path, schedule_path, sample_mode='ddpm', sample_steps=None, ddim_eta=0., seed=None):
+        if sample_mode not in ['ddpm', 'ddim', 'dpm_solver']:
+            raise NotImplementedError('Sample mode {} has not been implemented.'.format(sample_mode))
+        exported = np.load(schedule_path)
+        self.num_timesteps = len(exported['betas'])
+        self.sample_mode = sample_mode
+        self.sample_steps = sample_steps or self.num_timesteps
+        self.ddim_eta = ddim_eta
+        self.rng = np.random.default_rng(seed)
+        self.denoise_fn = load_denoise_fn(model_path)
+
+        if sample_mode == 'ddpm' and self.sample_steps != self.num_timesteps:
+            betas = respaced_betas(np.cumprod(1. - exported['betas']), space_timesteps(self.num_timesteps, self.sample_steps))
+            self.schedule = {key: value.astype(np.float32) for key, value in noise_schedule_coefficients(betas).items()}
+        else:
+            ''' the buffers registered by set_new_noise_schedule '''
+            self.schedule = {key: exported[key] for key in exported.files if key != 'betas'}
+
+    def extract(self, key, t):
+        return self.schedule[key][t].reshape(-1, 1, 1, 1)
+
+    def predict(self, y_cond, y_t, t):
+        ''' noise predicted by the UNet and the clipped y_0 it implies '''
+        gammas = self.schedule['gammas'][t].reshape(-1, 1)
+        noise = self.denoise_fn(np.concatenate([y_cond, y_t], axis=1), gammas)
+        y_0_hat = self.extract('sqrt_recip_gammas', t) * y_t - self.extract('sqrt_recipm1_gammas', t) * noise
+        return noise, np.clip(y_0_hat, -1., 1.)
+
+    def p_sample(self, y_t, t, y_cond):
+        _, y_0_hat = self.predict(y_cond, y_t, t)
+        model_mean = self.extract('posterior_mean_coef1', t) * y_0_hat + self.extract('posterior_mean_coef2', t) * y_t
+        if t[0] == 0:
+            return model_mean
+        noise = self.rng.standard_normal(y_t.shape, dtype=np.float32)
+        return model_mean + noise * np.exp(0.5 * self.extract('posterior_log_variance_clipped', t))
+
+    def ddim_sample(self, y_t, t, t_prev, y_cond):
+        _, y_0_hat = self.predict(y_cond, y_t, t)
+        # noise consistent with the clipped y_0_hat
+        noise = (self.extract('sqrt_recip_gammas', t) * y_t - y_0_hat) / self.extract('sqrt_recipm1_gammas', t)
+        gamma_t = self.extract('gammas', t)
+        gamma_prev = self.extract('gammas', t_prev) if t_prev[0] >= 0 else np.ones_like(gamma_t)
+
+        sigma = self.ddim_eta * np.sqrt((1 - gamma_prev) / (1 - gamma_t) * (1 - gamma_t / gamma_prev))
+        y_prev = np.sqrt(gamma_prev) * y_0_hat + np.sqrt(np.maximum(1 - gamma_prev - sigma ** 2, 0)) * noise
+        if self.ddim_eta > 0 and t_prev[0] >= 0:
+            y_prev = y_prev + sigma * self.rng.standard_normal(y_t.shape, dtype=np.float32)
+        return y_prev
+
+    def dpm_solver_sample(self, y_t, t, t_prev, y_cond, y_0_last=None, t_last=None):
+        ''' one DPM-Solver++(2M) step, returns the new state and the data prediction at t for the next step '''
+        _, y_0_hat = self.predict(y_cond, y_t, t)
+        if t_prev[0] < 0:
+            return y_0_hat, y_0_hat
+        gamma_t, gamma_prev = self.extract('gammas', t), self.extract('gammas', t_prev)
+        lambda_t = half_log_snr(gamma_t)
+        h = half_log_snr(gamma_prev) - lambda_t
+
+        data_pred = y_0_hat
+        if y_0_last is not None:
+            r = (lambda_t - half_log_snr(self.extract('gammas', t_last))) / h
+            data_pred = (1. + 0.5 / r) * y_0_hat - (0.5 / r) * y_0_last
+        y_prev = np.sqrt((1 - gamma_prev) / (1 - gamma_t)) * y_t - np.sqrt(gamma_prev) * np.expm1(-h) * data_pred
+        return y_prev, y_0_hat
+
+    def restoration(self, y_cond, y_t=None, y_0=None, mask=None):
+        b = y_cond.shape[0]
+        if self.sample_mode == 'ddpm':
+            timesteps = np.arange(self.sample_steps)[::-1]
+        else:
+            timesteps = space_timesteps(self.num_timesteps, self.sample_steps)[::-1]
+        y_t = self.rng.standard_normal(y_cond.shape, dtype=np.float32) if y_t is None else y_t
+        y_0_last, t_last = None, None
+        for idx, i in enumerate(timesteps):
+            t = np.full((b,), i, dtype=np.int64)
+            t_prev = np.full((b,), timesteps[idx+1] if idx+1 < len(timesteps) else -1, dtype=np.int64)
+            if self.sample_mode == 'ddim':
+                y_t = self.ddim_sample(y_t, t, t_prev, y_cond)
+            elif self.sample_mode == 'dpm_solver':
+                y_t, y_0_last = self.dpm_solver_sample(y_t, t, t_prev, y_cond, y_0_last=y_0_last, t_last=t_last)
+                t_last = t
+            else:
+                y_t = self.p_sample(y_t, t, y_cond)
+            if mask is not None:
+                y_t = y_0*(1.-mask) + mask*y_t
+        return y_t.astype(np.float32)
@@ -2,6 +2,7 @@ import math
 import torch
 from torch import nn
 from inspect import isfunction
+from ..guided_diffusion_modules.nn import attention
 
 class UNet(nn.Module):
     def __init__(
@@ -15,7 +16,9 @@ class UNet(nn.Module):
         res_blocks=3,
         dropout=0,
         with_noise_level_emb=True,
-        image_size=128
+        image_size=128,
+        attn_backend='einsum',
+        attn_chunk_size=1024
     ):
         super().__init__()
 
@@ -43,7 +46,7 @@ class UNet(nn.Module):
             channel_mult = inner_channel * channel_mults[ind]
             for _ in range(0, res_blocks):
                 downs.append(ResnetBlocWithAttn(
-                    pre_channel, channel_mult, noise_level_emb_dim=noise_level_channel, norm_groups=norm_groups, dropout=dropout, with_attn=use_attn))
+                    pre_channel, channel_mult, noise_level_emb_dim=noise_level_channel, norm_groups=norm_groups, dropout=dropout, with_attn=use_attn, attn_backend=attn_backend, attn_chunk_size=attn_chunk_size))
                 feat_channels.append(channel_mult)
                 pre_channel = channel_mult
             if not is_last:
@@ -54,7 +57,7 @@ class UNet(nn.Module):
 
         self.mid = nn.ModuleList([
             ResnetBlocWithAttn(pre_channel, pre_channel, noise_level_emb_dim=noise_level_channel, norm_groups=norm_groups,
-                               dropout=dropout, with_attn=True),
+                               dropout=dropout, with_attn=True, attn_backend=attn_backend, attn_chunk_size=attn_chunk_size),
             ResnetBlocWithAttn(pre_channel, pre_channel, noise_level_emb_dim=noise_level_channel, norm_groups=norm_groups,
                                dropout=dropout, with_attn=False)
         ])
@@ -67,7 +70,7 @@ class UNet(nn.Module):
             for _ in range(0, res_blocks+1):
                 ups.append(ResnetBlocWithAttn(
                     pre_channel+feat_channels.pop(), channel_mult, noise_level_emb_dim=noise_level_channel, norm_groups=norm_groups,
-                        dropout=dropout, with_attn=use_attn))
+                        dropout=dropout, with_attn=use_attn, attn_backend=attn_backend, attn_chunk_size=attn_chunk_size))
                 pre_channel = channel_mult
             if not is_last:
                 ups.append(Upsample(pre_channel))
@@ -196,10 +199,12 @@ class ResnetBlock(nn.Module):
 
 
 class SelfAttention(nn.Module):
-    def __init__(self, in_channel, n_head=1, norm_groups=32):
+    def __init__(self, in_channel, n_head=1, norm_groups=32, attn_backend='einsum', attn_chunk_size=1024):
         super().__init__()
 
         self.n_head = n_head
+        self.attn_backend = attn_backend
+        self.attn_chunk_size = attn_chunk_size
 
         self.norm = nn.GroupNorm(norm_groups, in_channel)
         self.qkv = nn.Conv2d(in_channel, in_channel * 3, 1, bias=False)
@@ -211,28 +216,24 @@ class SelfAttention(nn.Module):
         head_dim = channel // n_head
 
         norm = self.norm(input)
-        qkv = self.qkv(norm).view(batch, n_head, head_dim * 3, height, width)
-        query, key, value = qkv.chunk(3, dim=2)  # bhdyx
+        qkv = self.qkv(norm).view(batch * n_head, head_dim * 3, height * width)
+        query, key, value = qkv.chunk(3, dim=1)  # (bn)c(hw)
 
-        attn = torch.einsum("bnchw, bncyx -> bnhwyx", query, key).contiguous() / math.sqrt(channel)
-        attn = attn.view(batch, n_head, height, width, -1)
-        attn = torch.softmax(attn, -1)
-        attn = attn.view(batch, n_head, height, width, height, width)
-
-        out = torch.einsum("bnhwyx, bncyx -> bnchw", attn, value).contiguous()
-        out = self.out(out.view(batch, channel, height, width))
+        # attention scales by head_dim, sr3 has always scaled by the full channel
+        out = attention(query * math.sqrt(head_dim / channel), key, value, self.attn_backend, self.attn_chunk_size)
+        out = self.out(out.reshape(batch, channel, height, width))
 
         return out + input
 
 
 class ResnetBlocWithAttn(nn.Module):
-    def __init__(self, dim, dim_out, *, noise_level_emb_dim=None, norm_groups=32, dropout=0, with_attn=False):
+    def __init__(self, dim, dim_out, *, noise_level_emb_dim=None, norm_groups=32, dropout=0, with_attn=False, attn_backend='einsum', attn_chunk_size=1024):
         super().__init__()
         self.with_attn = with_attn
         self.res_block = ResnetBlock(
             dim, dim_out, noise_level_emb_dim, norm_groups=norm_groups, dropout=dropout)
         if with_attn:
-            self.attn = SelfAttention(dim_out, norm_groups=norm_groups)
+            self.attn = SelfAttention(dim_out, norm_groups=norm_groups, attn_backend=attn_backend, attn_chunk_size=attn_chunk_size)
 
     def forward(self, x, time_emb):
         x = self.res_block(x, time_emb)
@@ -0,0 +1,21 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.dataset import make_dataset
+from data.cache import build_image_cache
+
+if __name__ == '__main__':
+    ''' decodes and resizes the images of a data_root once, InpaintDataset reads them with cache_dir '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--data_root', type=str, required=True, help='flist or image directory, the data_root of the dataset')
+    parser.add_argument('-o', '--cache_dir', type=str, required=True)
+    parser.add_argument('--image_size', type=int, nargs=2, default=[512, 512])
+    parser.add_argument('--mask_mode', type=str, default=None, choices=['white_pixels', 'red_pixels'], help='Also store the masks of this mode')
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+
+    paths = make_dataset(args.data_root)
+    build_image_cache(paths, args.cache_dir, args.image_size, mask_mode=args.mask_mode, num_workers=args.num_workers)
+    print('Cached {} images of size {} in {}'.format(len(paths), args.image_size, args.cache_dir))
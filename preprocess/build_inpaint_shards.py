@@ -0,0 +1,20 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.dataset import make_dataset
+from data.shards import write_shards
+
+if __name__ == '__main__':
+    ''' packs the images of a data_root into tar shards, InpaintShardDataset streams them '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--data_root', type=str, required=True, help='flist or image directory, the data_root of the dataset')
+    parser.add_argument('-o', '--shard_root', type=str, required=True)
+    parser.add_argument('--shard_size', type=int, default=1000, help='Samples per shard')
+    parser.add_argument('--mask_dir', type=str, default=None, help='Directory with a PNG mask per image file name, stored next to the images')
+    args = parser.parse_args()
+
+    paths = make_dataset(args.data_root)
+    write_shards(paths, args.shard_root, shard_size=args.shard_size, mask_dir=args.mask_dir)
+    print('Packed {} images into {} shards in {}'.format(len(paths), (len(paths) + args.shard_size - 1) // args.shard_size, args.shard_root))
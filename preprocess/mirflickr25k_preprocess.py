@@ -1,55 +1,92 @@
+import argparse
 import os
+from multiprocessing import Pool
 import numpy as np
-from sklearn.model_selection import train_test_split
 import cv2
 
+AB_FILES = ["ab1.npy", "ab2.npy", "ab3.npy"]
+
 def convert_abl(ab, l):
-    """ convert AB and L to RGB """
-    l = np.expand_dims(l, axis=3)
-    lab = np.concatenate([l, ab], axis=3)
-    if len(lab.shape)==4:
-        image_color, image_l = [], []        
-        for _color, _l in zip(lab, l):
-            out = cv2.cvtColor(_color.astype('uint8'), cv2.COLOR_LAB2RGB) 
-            out = cv2.cvtColor(out, cv2.COLOR_RGB2BGR) 
-            image_color.append(out)
-            image_l.append(cv2.cvtColor(_l.astype('uint8'), cv2.COLOR_GRAY2RGB))
-        image_color = np.array(image_color)
-        image_l = np.array(image_l)
+    """ convert AB and L to RGB, batches are converted in one call by stacking the images vertically """
+    l = np.expand_dims(l, axis=-1)
+    lab = np.concatenate([l, ab], axis=-1).astype('uint8')
+    if lab.ndim == 4:
+        n, h, w, _ = lab.shape
+        image_color = cv2.cvtColor(lab.reshape(n*h, w, 3), cv2.COLOR_LAB2RGB).reshape(n, h, w, 3)
+        image_l = np.repeat(l.astype('uint8'), 3, axis=-1)
     else:
-        image_color = cv2.cvtColor(lab.astype('uint8'), cv2.COLOR_LAB2RGB)
+        image_color = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
         image_l = cv2.cvtColor(l.astype('uint8'), cv2.COLOR_GRAY2RGB)
     return image_color, image_l
 
 def load_data(home):
-    ab1 = np.load(os.path.join(home,"ab/ab", "ab1.npy"))
-    ab2 = np.load(os.path.join(home, "ab/ab", "ab2.npy"))
-    ab3 = np.load(os.path.join(home,"ab/ab", "ab3.npy"))
-    ab = np.concatenate([ab1, ab2, ab3], axis=0)
-    l = np.load(os.path.join(home,"l/gray_scale.npy"))
+    """ memory-mapped ab parts and L, the parts are not concatenated so nothing is read before it is converted """
+    ab = [np.load(os.path.join(home, "ab/ab", name), mmap_mode='r') for name in AB_FILES]
+    l = np.load(os.path.join(home, "l/gray_scale.npy"), mmap_mode='r')
     return ab, l
 
+def read_ab(ab, start, end):
+    """ rows [start, end) of the ab parts as if they were concatenated """
+    parts, offset = [], 0
+    for part in ab:
+        lo, hi = max(start - offset, 0), min(end - offset, len(part))
+        if lo < hi:
+            parts.append(part[lo:hi])
+        offset += len(part)
+    return np.concatenate(parts, axis=0)
+
+def convert_chunk(args):
+    """ converts rows [start, end) and writes them as PNGs or into the packed arrays, runs in a worker process """
+    home, start, end, image_save_path, output = args
+    ab, l = load_data(home)
+    image_color, image_l = convert_abl(read_ab(ab, start, end), l[start:end])
+    if output == 'png':
+        for i in range(start, end):
+            name = '{}.png'.format(str(i).zfill(5))
+            cv2.imwrite(os.path.join(image_save_path, 'color', name), cv2.cvtColor(image_color[i - start], cv2.COLOR_RGB2BGR))
+            cv2.imwrite(os.path.join(image_save_path, 'gray', name), image_l[i - start])
+    else:
+        color = np.load(os.path.join(image_save_path, 'color.npy'), mmap_mode='r+')
+        gray = np.load(os.path.join(image_save_path, 'gray.npy'), mmap_mode='r+')
+        color[start:end] = image_color
+        gray[start:end] = image_l[..., 0]
+        color.flush()
+        gray.flush()
+    return end - start
+
 if __name__ == '__main__':
-    home = './' # path saved .npy
-    flist_save_path = './flist'
-    image_save_path = './images' # images save path
-
-    all_color, all_l = load_data(home)
-    image_color, image_l = convert_abl(all_color, all_l)
-    
-    color_save_path, gray_save_path  = '{}/color'.format(image_save_path), '{}/gray'.format(image_save_path)
-    os.makedirs(color_save_path, exist_ok=True)
-    os.makedirs(gray_save_path, exist_ok=True)
-    for i in range(image_color.shape[0]):
-        cv2.imwrite('{}/{}.png'.format(color_save_path, str(i).zfill(5)), image_color[i])
-    for i in range(image_l.shape[0]):
-        cv2.imwrite('{}/{}.png'.format(gray_save_path, str(i).zfill(5)), image_l[i])
-    
-    os.makedirs(flist_save_path, exist_ok=True)
-    arr = np.random.permutation(25000)
-    with open('{}/train.flist'.format(flist_save_path), 'w') as f:
-        for item in arr[:24000]:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--home', type=str, default='./', help='path saved .npy')
+    parser.add_argument('--flist_save_path', type=str, default='./flist')
+    parser.add_argument('--image_save_path', type=str, default='./images', help='images save path')
+    parser.add_argument('--output', type=str, default='png', choices=['png', 'packed'],
+        help='png: color/ and gray/ PNGs, packed: color.npy [n, h, w, 3] and gray.npy [n, h, w] read by ColorizationDataset(packed=True)')
+    parser.add_argument('--chunk_size', type=int, default=500)
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    ab, l = load_data(args.home)
+    num_images, h, w = l.shape
+    assert sum(len(part) for part in ab) == num_images, 'ab and L have different numbers of images'
+
+    if args.output == 'png':
+        os.makedirs(os.path.join(args.image_save_path, 'color'), exist_ok=True)
+        os.makedirs(os.path.join(args.image_save_path, 'gray'), exist_ok=True)
+    else:
+        os.makedirs(args.image_save_path, exist_ok=True)
+        np.lib.format.open_memmap(os.path.join(args.image_save_path, 'color.npy'), mode='w+', dtype=np.uint8, shape=(num_images, h, w, 3))
+        np.lib.format.open_memmap(os.path.join(args.image_save_path, 'gray.npy'), mode='w+', dtype=np.uint8, shape=(num_images, h, w))
+
+    chunks = [(args.home, start, min(start + args.chunk_size, num_images), args.image_save_path, args.output) for start in range(0, num_images, args.chunk_size)]
+    with Pool(args.num_workers) as pool:
+        converted = sum(pool.imap_unordered(convert_chunk, chunks))
+    print('Converted {} images to {} in {}'.format(converted, args.output, args.image_save_path))
+
+    os.makedirs(args.flist_save_path, exist_ok=True)
+    arr = np.random.permutation(num_images)
+    with open('{}/train.flist'.format(args.flist_save_path), 'w') as f:
+        for item in arr[:num_images - 1000]:
+            print(str(item).zfill(5), file=f)
+    with open('{}/test.flist'.format(args.flist_save_path), 'w') as f:
+        for item in arr[num_images - 1000:]:
             print(str(item).zfill(5), file=f)
-    with open('{}/test.flist'.format(flist_save_path), 'w') as f:
-        for item in arr[24000:]:
-            print(str(item).zfill(5), file=f)
\ No newline at end of file
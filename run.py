@@ -70,6 +70,8 @@ if __name__ == '__main__':
     parser.add_argument('-gpu', '--gpu_ids', type=str, default=None)
     parser.add_argument('-d', '--debug', action='store_true')
     parser.add_argument('-P', '--port', default='21012', type=str)
+    parser.add_argument('--sample_mode', type=str, choices=['ddpm','ddim','dpm_solver'], default=None, help='Sampler used by restoration')
+    parser.add_argument('--sample_steps', type=int, default=None, help='Number of sampling steps (network evaluations)')
 
     ''' parser configs '''
     args = parser.parse_args()
@@ -0,0 +1,100 @@
+import os
+import sys
+import pytest
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core.praser import dict_to_nonedict
+from models.model import Palette
+from models.network import Network
+
+def make_network(sample_config={}, n_timestep=50, **unet_kwargs):
+    ''' small guided_diffusion network on CPU with the test schedule '''
+    unet = dict(in_channel=6, out_channel=3, inner_channel=32, channel_mults=[1, 2], attn_res=[2], num_head_channels=16,
+        res_blocks=1, dropout=0., image_size=32)
+    unet.update(unet_kwargs)
+    beta_schedule = {
+        'train': {'schedule': 'linear', 'n_timestep': n_timestep, 'linear_start': 1e-6, 'linear_end': 0.01},
+        'test': {'schedule': 'linear', 'n_timestep': n_timestep, 'linear_start': 1e-4, 'linear_end': 0.09},
+    }
+    network = Network(unet, beta_schedule, module_name='guided_diffusion', sample_config=sample_config)
+    network.set_new_noise_schedule(device=torch.device('cpu'), phase='test')
+    return network.eval()
+
+@pytest.fixture
+def inpaint_batch():
+    ''' gt image, conditional image and a box mask of a [2, 3, 32, 32] batch '''
+    generator = torch.Generator().manual_seed(0)
+    y_0 = torch.rand(2, 3, 32, 32, generator=generator) * 2 - 1
+    mask = torch.zeros(2, 1, 32, 32)
+    mask[:, :, 8:20, 10:24] = 1
+    y_cond = y_0 * (1 - mask) + mask * torch.randn(2, 3, 32, 32, generator=generator)
+    return y_0, y_cond, mask
+
+
+def mse_loss(output, target):
+    ''' the training loss of models/loss.py, without its perceptual-loss dependencies '''
+    return F.mse_loss(output, target)
+
+def mae(input, target):
+    return (input - target).abs().mean()
+
+class InpaintSamples(torch.utils.data.Dataset):
+    ''' [3, 32, 32] inpainting samples like InpaintDataset returns them '''
+    def __init__(self, num_samples=4):
+        self.num_samples = num_samples
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        generator = torch.Generator().manual_seed(index)
+        gt_image = torch.rand(3, 32, 32, generator=generator) * 2 - 1
+        mask = torch.zeros(1, 32, 32)
+        mask[:, 8:20, 10:24] = 1
+        cond_image = gt_image*(1. - mask) + mask*torch.randn(3, 32, 32, generator=generator)
+        return {'gt_image': gt_image, 'cond_image': cond_image, 'mask_image': gt_image*(1. - mask) + mask,
+            'mask': mask, 'path': '{:02d}.png'.format(index)}
+
+class Logger():
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg):
+        self.messages.append(msg)
+
+    warning = info
+
+class Writer():
+    ''' VisualWriter that keeps the scalars and saved results in memory '''
+    def __init__(self):
+        self.scalars, self.results = [], []
+
+    def set_iter(self, epoch, iter, phase='train'):
+        pass
+
+    def add_scalar(self, key, value):
+        self.scalars.append(key)
+
+    def add_images(self, key, value):
+        pass
+
+    def save_images(self, results):
+        self.results.append(results)
+
+def make_palette(phase='train', model_cls=Palette, batch_size=2, num_samples=4, train={}, sample_config={}, resume_state=None, 
+        checkpoint=None, **kwargs):
+    ''' Palette on CPU with a small network, an in-memory dataset and a logger and writer that record what they get '''
+    opt = {
+        'phase': phase, 'global_rank': 0, 'distributed': False, 'seed': 0,
+        'datasets': {phase: {'dataloader': {'args': {'batch_size': batch_size}}}},
+        'path': {'resume_state': resume_state, 'checkpoint': checkpoint},
+        'train': dict({'n_epoch': 1, 'n_iter': 1e8, 'log_iter': 1e8, 'save_checkpoint_epoch': 1, 'val_epoch': 1}, **train),
+    }
+    loader = torch.utils.data.DataLoader(InpaintSamples(num_samples), batch_size=batch_size)
+    model_args = dict(networks=[make_network(sample_config)], losses=[mse_loss], sample_num=2, task='inpainting',
+        optimizers=[{'lr': 1e-4}], opt=dict_to_nonedict(opt), phase_loader=loader, val_loader=loader, metrics=[mae],
+        logger=Logger(), writer=Writer())
+    model_args.update(kwargs)
+    return model_cls(**model_args)
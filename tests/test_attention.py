@@ -0,0 +1,62 @@
+import math
+import pytest
+import torch
+
+from conftest import make_network
+from models.guided_diffusion_modules.nn import attention
+from models.sr3_modules.unet import SelfAttention
+
+
+@pytest.mark.parametrize('backend', ['sdpa', 'chunked'])
+@pytest.mark.parametrize('chunk_size', [7, 64, 1024])
+def test_attention_backends_match_einsum(backend, chunk_size):
+    ''' chunk sizes that do not divide the sequence, that divide it and that cover it at once '''
+    generator = torch.Generator().manual_seed(0)
+    q, k, v = [torch.randn(3, 16, 64, generator=generator) * 3 for _ in range(3)]
+    expected = attention(q, k, v, backend='einsum')
+    assert torch.allclose(attention(q, k, v, backend=backend, chunk_size=chunk_size), expected, atol=1e-5)
+
+def test_chunked_attention_keys_differ_from_queries():
+    ''' cross attention shape: T queries over S keys '''
+    generator = torch.Generator().manual_seed(0)
+    q = torch.randn(2, 8, 20, generator=generator)
+    k, v = torch.randn(2, 8, 45, generator=generator), torch.randn(2, 8, 45, generator=generator)
+    assert torch.allclose(attention(q, k, v, backend='chunked', chunk_size=16), attention(q, k, v, backend='einsum'), atol=1e-5)
+
+def test_attention_rejects_unknown_backend():
+    q = torch.randn(1, 4, 8)
+    with pytest.raises(NotImplementedError):
+        attention(q, q, q, backend='flash')
+
+@pytest.mark.parametrize('use_new_attention_order', [False, True])
+def test_unet_backends_match(inpaint_batch, use_new_attention_order):
+    y_0, y_cond, _ = inpaint_batch
+    gammas = torch.tensor([[0.3], [0.8]])
+    outputs = []
+    for backend in ['einsum', 'sdpa', 'chunked']:
+        network = make_network(attn_backend=backend, attn_chunk_size=5, use_new_attention_order=use_new_attention_order)
+        ''' output projections are zero at initialisation, random weights make the attention layers count '''
+        generator = torch.Generator().manual_seed(0)
+        with torch.no_grad():
+            for param in network.denoise_fn.parameters():
+                param.copy_(torch.randn(param.shape, generator=generator) * 0.1)
+            outputs.append(network.denoise_fn(torch.cat([y_cond, y_0], dim=1), gammas))
+    for output in outputs[1:]:
+        assert torch.allclose(output, outputs[0], atol=1e-5)
+
+@pytest.mark.parametrize('backend', ['einsum', 'sdpa', 'chunked'])
+@pytest.mark.parametrize('n_head', [1, 2])
+def test_sr3_self_attention_matches_6d_reference(backend, n_head):
+    ''' the original sr3 layer, which built the [b, n, h, w, h, w] attention tensor '''
+    torch.manual_seed(0)
+    layer = SelfAttention(32, n_head=n_head, norm_groups=8, attn_backend=backend, attn_chunk_size=10).eval()
+    x = torch.randn(2, 32, 6, 5)
+    batch, channel, height, width = x.shape
+    with torch.no_grad():
+        qkv = layer.qkv(layer.norm(x)).view(batch, n_head, channel // n_head * 3, height, width)
+        query, key, value = qkv.chunk(3, dim=2)
+        attn = torch.einsum('bnchw, bncyx -> bnhwyx', query, key) / math.sqrt(channel)
+        attn = torch.softmax(attn.reshape(batch, n_head, height, width, -1), -1).view(batch, n_head, height, width, height, width)
+        out = torch.einsum('bnhwyx, bncyx -> bnchw', attn, value)
+        expected = layer.out(out.reshape(batch, channel, height, width)) + x
+        assert torch.allclose(layer(x), expected, atol=1e-5)
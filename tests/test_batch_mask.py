@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import torch
+
+from data.util.batch_mask import INPAINT_MASK_MODES, UNCROP_MASK_MODES, batch_inpaint_masks, batch_uncrop_masks
+from data.util.mask import bbox2mask, brush_stroke_mask, random_bbox, random_cropping_bbox
+
+IMAGE_SIZE = (256, 256)
+
+''' the per-sample numpy generators of InpaintDataset.get_mask and UncroppingDataset.get_mask '''
+NUMPY_INPAINT_MASKS = {
+    'bbox': lambda: bbox2mask(IMAGE_SIZE, random_bbox()),
+    'center': lambda: bbox2mask(IMAGE_SIZE, (IMAGE_SIZE[0]//4, IMAGE_SIZE[1]//4, IMAGE_SIZE[0]//2, IMAGE_SIZE[1]//2)),
+    'free_form': lambda: brush_stroke_mask(IMAGE_SIZE),
+    'hybrid': lambda: bbox2mask(IMAGE_SIZE, random_bbox()) | brush_stroke_mask(IMAGE_SIZE),
+}
+NUMPY_UNCROP_MASKS = {
+    'onedirection': lambda: bbox2mask(IMAGE_SIZE, random_cropping_bbox(mask_mode='onedirection')),
+    'fourdirection': lambda: bbox2mask(IMAGE_SIZE, random_cropping_bbox(mask_mode='fourdirection')),
+    'hybrid': lambda: bbox2mask(IMAGE_SIZE, random_cropping_bbox(mask_mode=['onedirection', 'fourdirection'][np.random.randint(0, 2)])),
+}
+
+@pytest.fixture(autouse=True)
+def seed():
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+def areas(masks):
+    return masks.float().mean(dim=(1, 2, 3))
+
+def numpy_areas(generate, num_samples=256):
+    return torch.tensor([generate().mean() for _ in range(num_samples)], dtype=torch.float32)
+
+def check_batch(masks, batch_size):
+    ''' uint8 like the masks of bbox2mask and brush_stroke_mask '''
+    assert masks.shape == (batch_size, 1, *IMAGE_SIZE) and masks.dtype == torch.uint8
+    assert set(masks.unique().tolist()) <= {0, 1}
+
+
+@pytest.mark.parametrize('mask_mode', INPAINT_MASK_MODES)
+def test_inpaint_masks_match_numpy(mask_mode):
+    masks = batch_inpaint_masks(mask_mode, 64, IMAGE_SIZE)
+    check_batch(masks, 64)
+    area, expected = areas(masks), numpy_areas(NUMPY_INPAINT_MASKS[mask_mode])
+    if mask_mode == 'center':
+        ''' the [h, w, 1] numpy mask is the mask of every sample '''
+        assert (masks == torch.from_numpy(NUMPY_INPAINT_MASKS['center']()).permute(2, 0, 1)).all()
+    elif mask_mode == 'bbox':
+        ''' boxes of 108 to 128 pixels a side, at least 20 pixels from the border '''
+        assert area.min() >= 108 * 108 / 65536 and area.max() <= 128 * 128 / 65536
+        assert expected.min() >= 108 * 108 / 65536 and expected.max() <= 128 * 128 / 65536
+        assert (masks[..., :20, :] == 0).all() and (masks[..., :, :20] == 0).all()
+        assert (masks[..., -20:, :] == 0).all() and (masks[..., :, -20:] == 0).all()
+    ''' strokes are rasterised differently, the areas follow the same distribution '''
+    assert abs(area.mean() - expected.mean()) < 0.04
+    assert area.min() >= expected.min() * 0.5 and area.max() <= min(expected.max() * 1.5, 1.)
+    assert area.std() == pytest.approx(expected.std().item(), abs=0.03)
+
+@pytest.mark.parametrize('mask_mode', UNCROP_MASK_MODES)
+def test_uncrop_masks_match_numpy(mask_mode):
+    masks = batch_uncrop_masks(mask_mode, 256, IMAGE_SIZE)
+    check_batch(masks, 256)
+    area, expected = areas(masks), numpy_areas(NUMPY_UNCROP_MASKS[mask_mode])
+    ''' every crop covers about half of the image '''
+    assert area.min() >= expected.min() - 0.01 and area.max() <= expected.max() + 0.01
+    assert (area - 0.5).abs().max() < 0.01
+    if mask_mode == 'onedirection':
+        ''' the four halves of onedirection are all drawn '''
+        halves = torch.stack([masks[:, 0, :, :128].all((1, 2)), masks[:, 0, :128].all((1, 2)),
+            masks[:, 0, 128:].all((1, 2)), masks[:, 0, :, 128:].all((1, 2))], 1)
+        assert (halves.sum(1) == 1).all() and halves.any(0).all()
+
+@pytest.mark.parametrize('generate', [batch_inpaint_masks, batch_uncrop_masks])
+def test_unknown_mode_raises(generate):
+    with pytest.raises(NotImplementedError):
+        generate('file', 2, IMAGE_SIZE)
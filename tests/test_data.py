@@ -0,0 +1,139 @@
+import os
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torch.utils.data import default_collate
+
+import core.file_index
+from core.file_index import FileIndex
+from data.dataset import InpaintDataset, InpaintShardDataset, is_image_file, make_dataset
+from data.shards import write_shards, load_shard_index, iter_shard
+from data.util.batch_mask import pack_mask_bits, unpack_mask_bits
+from data.util import mask_bank
+from data.util.mask_bank import MaskBank
+
+IMAGE_SIZE = [32, 37]
+
+@pytest.fixture(autouse=True)
+def index_dir(tmp_path, monkeypatch):
+    ''' file indexes of the test datasets stay out of the user cache '''
+    monkeypatch.setattr(core.file_index, 'INDEX_DIR', str(tmp_path / 'index'))
+
+@pytest.fixture
+def image_dir(tmp_path):
+    ''' four random images of IMAGE_SIZE with a white block, whose width is not a multiple of 8 '''
+    rng = np.random.RandomState(0)
+    root = tmp_path / 'images'
+    root.mkdir()
+    for idx in range(4):
+        img = rng.randint(0, 200, (*IMAGE_SIZE, 3)).astype(np.uint8)
+        img[4+idx:12+idx, 6:20+idx] = 255
+        Image.fromarray(img).save(root / '{:02d}.png'.format(idx))
+    return str(root)
+
+
+@pytest.mark.parametrize('width', [8, 37, 64])
+def test_mask_bits_round_trip(width):
+    masks = (torch.rand(3, 1, 5, width, generator=torch.Generator().manual_seed(0)) > 0.5).to(torch.uint8)
+    bits = torch.stack([pack_mask_bits(mask) for mask in masks])
+    assert bits.shape == (3, 5, (width + 7) // 8) and bits.dtype == torch.uint8
+    assert torch.equal(unpack_mask_bits(bits, width), masks)
+
+@pytest.mark.parametrize('mask_mode', ['center', 'white_pixels'])
+def test_lean_batch_matches_samples(image_dir, mask_mode):
+    ''' lean uint8 samples with bit-packed masks give the same batch as the normalised samples after batch_stage '''
+    config = dict(data_root=image_dir, mask_config={'mask_mode': mask_mode}, image_size=IMAGE_SIZE)
+    dataset, lean_dataset = InpaintDataset(**config), InpaintDataset(lean=True, **config)
+    batch = default_collate([dataset[idx] for idx in range(len(dataset))])
+    lean_batch = default_collate([lean_dataset[idx] for idx in range(len(lean_dataset))])
+    assert lean_batch['gt_image'].dtype == torch.uint8
+    lean_batch = lean_dataset.batch_stage(lean_batch)
+    assert batch['mask'].flatten(1).sum(1).min() > 0
+    assert lean_batch['path'] == batch['path']
+    assert torch.equal(lean_batch['mask'].float(), batch['mask'].float())
+    for key in ['gt_image', 'mask_image']:
+        assert torch.allclose(lean_batch[key], batch[key], atol=1e-6)
+    known = 1 - batch['mask']
+    assert torch.allclose(lean_batch['cond_image'] * known, batch['cond_image'] * known, atol=1e-6)
+
+
+@pytest.mark.parametrize('mask_mode', ['irregular', 'free_form'])
+def test_mask_bank_round_trip(tmp_path, mask_mode):
+    config = dict(bank_dir=str(tmp_path), mask_mode=mask_mode, image_size=IMAGE_SIZE, num_masks=10, num_workers=2, flip=False)
+    bank = MaskBank(**config)
+    assert len(bank) == 10 and bank.bank.shape == (10, IMAGE_SIZE[0], (IMAGE_SIZE[1] + 7) // 8)
+    masks = np.unpackbits(np.asarray(bank.bank), axis=-1, count=IMAGE_SIZE[1])
+    assert masks.reshape(10, -1).sum(1).min() > 0
+    # a bank of the same seed is reused, another seed gives other masks
+    assert np.array_equal(MaskBank(**config).bank, bank.bank)
+    config['seed'] = 1
+    assert not np.array_equal(MaskBank(**config).bank, bank.bank)
+    np.random.seed(0)
+    for _ in range(5):
+        mask = bank.sample()
+        assert mask.shape == (*IMAGE_SIZE, 1) and mask.dtype == np.uint8
+        assert any(np.array_equal(mask[..., 0], stored) for stored in masks)
+
+def test_mask_bank_from_image_keeps_one_mask(tmp_path, monkeypatch):
+    # the mask file of from_image is not part of the repository
+    mask = np.zeros((*IMAGE_SIZE, 1), dtype=np.uint8)
+    mask[2:10, 3:30] = 1
+    monkeypatch.setitem(mask_bank.MASK_GENERATORS, 'from_image', lambda image_size: mask)
+    bank = MaskBank(str(tmp_path), 'from_image', IMAGE_SIZE, num_masks=10, num_workers=1, flip=True, roll=True)
+    assert len(bank) == 1
+    np.random.seed(0)
+    for _ in range(10):
+        assert np.array_equal(bank.sample(), mask)
+
+
+@pytest.mark.parametrize('with_masks', [False, True])
+def test_shards_round_trip(tmp_path, image_dir, with_masks):
+    paths = make_dataset(image_dir)
+    mask_dir = None
+    if with_masks:
+        mask_dir = tmp_path / 'masks'
+        mask_dir.mkdir()
+        for path in paths:
+            Image.new('L', IMAGE_SIZE[::-1], 255).save(mask_dir / os.path.basename(path))
+    shard_dir = str(tmp_path / 'shards')
+    write_shards(paths, shard_dir, shard_size=3, mask_dir=str(mask_dir) if with_masks else None)
+    index = load_shard_index(shard_dir)
+    assert [shard['count'] for shard in index['shards']] == [3, 1] and index['masks'] == with_masks
+    samples = [sample for shard in index['shards'] for sample in iter_shard(os.path.join(shard_dir, shard['name']))]
+    assert [sample['path'] for sample in samples] == [os.path.basename(path) for path in paths]
+    for sample, path in zip(samples, paths):
+        with open(path, 'rb') as f:
+            assert sample['image'] == f.read()
+        assert ('mask' in sample) == with_masks
+
+@pytest.mark.parametrize('batch_size', [1, 3])
+def test_shard_dataset_splits_over_gpus(tmp_path, image_dir, batch_size):
+    ''' every GPU yields len(dataset) samples, together they cover the whole dataset '''
+    paths = make_dataset(image_dir)
+    shard_dir = str(tmp_path / 'shards')
+    write_shards(paths, shard_dir, shard_size=1)
+    seen = []
+    for rank in range(2):
+        dataset = InpaintShardDataset(shard_dir, mask_config={'mask_mode': 'center'}, image_size=IMAGE_SIZE, shuffle_buffer=2)
+        dataset.rank, dataset.world_size = rank, 2
+        dataset.set_loader(batch_size=batch_size, num_workers=0)
+        samples = list(dataset)
+        assert len(samples) == len(dataset) == -(-2 // batch_size) * batch_size
+        assert samples[0]['gt_image'].shape == (3, *IMAGE_SIZE) and samples[0]['mask'].shape == (1, *IMAGE_SIZE)
+        seen += [sample['path'] for sample in samples]
+    assert set(seen) == set(os.path.basename(path) for path in paths)
+
+
+def test_file_index_on_read_only_data(tmp_path, image_dir):
+    os.chmod(image_dir, 0o555)
+    try:
+        index = FileIndex(image_dir, is_image_file)
+        assert os.path.exists(index.index_path) and not any(name.endswith('.pkl') for name in os.listdir(image_dir))
+        assert os.path.dirname(index.index_path) == str(tmp_path / 'index')
+        assert index.paths == sorted(os.path.join(image_dir, name) for name in os.listdir(image_dir))
+    finally:
+        os.chmod(image_dir, 0o755)
+    ''' a new file is picked up by the next launch '''
+    Image.new('RGB', IMAGE_SIZE[::-1]).save(os.path.join(image_dir, '99.png'))
+    assert FileIndex(image_dir, is_image_file).paths[-1] == os.path.join(image_dir, '99.png')
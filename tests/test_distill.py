@@ -0,0 +1,79 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from conftest import make_network, make_palette
+from models.model import PaletteDistill
+from models.runtime import space_timesteps
+
+
+class FixedNoise(nn.Module):
+    ''' UNet that predicts a given noise, to sample the student with its distillation target '''
+    def __init__(self, noise):
+        super().__init__()
+        self.register_buffer('noise', noise)
+
+    def forward(self, x, gammas):
+        return self.noise
+
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_student_step_on_target_matches_two_teacher_steps(inpaint_batch, masked):
+    y_0, y_cond, mask = inpaint_batch
+    mask = mask if masked else None
+    teacher, student = make_network(), make_network()
+    # the output layer of the UNet is zero at initialisation, random weights give the teacher a real prediction
+    generator = torch.Generator().manual_seed(0)
+    with torch.no_grad():
+        for param in teacher.parameters():
+            param.copy_(torch.randn(param.shape, generator=generator) * 0.05)
+    sample_steps, noise = 4, torch.randn_like(y_0)
+    targets = []
+    def record_target(target, noise_hat):
+        targets.append(target)
+        return (target - noise_hat).pow(2).mean()
+    student.set_loss(record_target)
+
+    ''' the timesteps distillation_loss draws for every sample '''
+    torch.manual_seed(0)
+    j = torch.randint(0, sample_steps, (2,))
+    grid = torch.as_tensor(space_timesteps(student.num_timesteps, 2*sample_steps))
+    t, t_mid = grid[2*j+1], grid[2*j]
+    t_prev = torch.where(j > 0, grid[(2*j-1).clamp(min=0)], torch.full_like(j, -1))
+    torch.manual_seed(0)
+    with torch.no_grad():
+        student(y_0, y_cond, mask=mask, noise=noise, teacher=teacher, sample_steps=sample_steps)
+
+    y_t = student.q_sample(y_0, student.gammas_at(t, y_0.shape), noise=noise)
+    if masked:
+        y_t = y_t*mask + (1.-mask)*y_0
+    y_mid = teacher.ddim_sample(y_t, t, t_mid, y_cond=y_cond)
+    if masked:
+        y_mid = y_0*(1.-mask) + mask*y_mid
+    expected = teacher.ddim_sample(y_mid, t_mid, t_prev, y_cond=y_cond)
+    student.denoise_fn = FixedNoise(targets[0])
+    y_prev = student.ddim_sample(y_t, t, t_prev, clip_denoised=False, y_cond=y_cond)
+    if masked:
+        expected, y_prev = expected*mask, y_prev*mask
+    assert torch.allclose(y_prev, expected, atol=1e-4)
+
+def test_update_round_halves_the_steps(tmp_path):
+    teacher = make_network()
+    torch.save(teacher.state_dict(), str(tmp_path / 'teacher_Network.pth'))
+    distill_config = {'teacher_state': str(tmp_path / 'teacher'), 'start_steps': 8, 'min_steps': 2, 'round_iter': 10}
+    model = make_palette(model_cls=PaletteDistill, distill_config=distill_config,
+        ema_scheduler={'ema_start': 0, 'ema_iter': 1, 'ema_decay': 0.9})
+    network = model.get_network()
+    assert (model.distill_round, model.sample_steps) == (0, 8)
+    assert (network.sample_mode, network.sample_steps) == ('ddim', 8)
+    ''' the teacher is replaced by the EMA weights of the student when a round ends '''
+    with torch.no_grad():
+        for param in model.netG_EMA.parameters():
+            param.add_(1.)
+    for iter, (distill_round, sample_steps) in [(9, (0, 8)), (10, (1, 4)), (25, (2, 2)), (100, (2, 2))]:
+        model.iter = iter
+        model.update_round()
+        assert (model.distill_round, model.sample_steps) == (distill_round, sample_steps)
+        assert network.sample_steps == sample_steps
+    for teacher_param, ema_param in zip(model.teacher.parameters(), model.netG_EMA.parameters()):
+        assert torch.equal(teacher_param, ema_param)
@@ -0,0 +1,82 @@
+import copy
+import pytest
+import torch
+import torch.nn as nn
+
+from conftest import make_palette
+from models.model import EMA
+
+
+def make_models(dtype=torch.float32, device='cpu'):
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(8, 16), nn.Linear(16, 4))
+    ema_model = copy.deepcopy(model).to(device=device, dtype=dtype)
+    with torch.no_grad():
+        for param in model.parameters():
+            param.add_(1.)
+    return ema_model, model
+
+def lerp_reference(ema_model, model, weight):
+    return [ma.float() + weight * (p.float() - ma.float()) for ma, p in zip(ema_model.parameters(), model.parameters())]
+
+
+@pytest.mark.parametrize('device', ['cpu', pytest.param('cuda', marks=pytest.mark.skipif(not torch.cuda.is_available(), reason='no GPU'))])
+@pytest.mark.parametrize('dtype', [torch.float32, torch.bfloat16])
+def test_update_keeps_placement(device, dtype):
+    ema_model, model = make_models(dtype, device)
+    expected = lerp_reference(ema_model, model, 0.5)
+    EMA(beta=0.5).update_model_average(ema_model, model)
+    for param, reference in zip(ema_model.parameters(), expected):
+        assert param.dtype == dtype and param.device.type == device
+        assert torch.allclose(param.float(), reference.to(device), atol=torch.finfo(dtype).eps * 4)
+
+def test_pending_steps_are_folded_into_the_decay():
+    ema_model, model = make_models()
+    ema = EMA(beta=0.9)
+    for _ in range(3):
+        ema.step()
+    assert ema.get_decay() == pytest.approx(0.9**3)
+    expected = lerp_reference(ema_model, model, 1. - 0.9**3)
+    ema.update_model_average(ema_model, model)
+    assert (ema.num_updates, ema.pending_steps) == (1, 0)
+    assert ema.get_decay() == pytest.approx(0.9)
+    for param, reference in zip(ema_model.parameters(), expected):
+        assert torch.allclose(param, reference, atol=1e-6)
+
+def test_warmup_lowers_the_first_decays():
+    ema_model, model = make_models()
+    ema = EMA(beta=0.9999, warmup=True)
+    decays = []
+    for _ in range(3):
+        decays.append(ema.get_decay())
+        ema.update_model_average(ema_model, model)
+    assert decays == pytest.approx([1/10, 2/11, 3/12])
+    ema.num_updates = 10**6
+    assert ema.get_decay() == pytest.approx(0.9999)
+
+@pytest.mark.parametrize('dtype', [torch.bfloat16, torch.float16])
+def test_low_precision_ema_follows_float32(dtype):
+    ''' updates of weight 1e-4 are below the rounding step of dtype, the residuals still add them up '''
+    ema_model, model = make_models(dtype)
+    reference_model = copy.deepcopy(ema_model).float()
+    start = [param.clone() for param in ema_model.parameters()]
+    ema, reference = EMA(beta=0.9999), EMA(beta=0.9999)
+    for _ in range(1000):
+        ema.update_model_average(ema_model, model)
+        reference.update_model_average(reference_model, model)
+    for param, reference_param, start_param in zip(ema_model.parameters(), reference_model.parameters(), start):
+        assert not torch.equal(param, start_param)
+        assert torch.allclose(param.float(), reference_param, atol=2 * torch.finfo(dtype).eps * reference_param.abs().max().item())
+
+def test_palette_saves_the_ema_state(tmp_path):
+    ema_scheduler = {'ema_start': 0, 'ema_iter': 1, 'ema_decay': 0.9999, 'ema_dtype': 'bfloat16'}
+    model = make_palette(checkpoint=str(tmp_path), ema_scheduler=ema_scheduler)
+    assert next(model.netG_EMA.parameters()).dtype == torch.bfloat16
+    model.train_step()
+    model.epoch = 1
+    model.save_everything()
+    assert model.EMA.num_updates == 2 and model.EMA.residuals is not None
+    resumed = make_palette(resume_state=str(tmp_path / '1'), ema_scheduler=ema_scheduler)
+    assert resumed.EMA.num_updates == 2
+    for residual, resumed_residual in zip(model.EMA.residuals, resumed.EMA.residuals):
+        assert torch.equal(residual, resumed_residual)
@@ -0,0 +1,60 @@
+import contextlib
+import pytest
+import torch
+import torch.ao.nn.quantized as nnq
+
+from conftest import make_palette
+
+
+@pytest.mark.parametrize('trajectory', ['final', 'snapshots'])
+def test_saved_results_of_trajectory(trajectory):
+    ''' Process_ images are only written for snapshots, final writes the output once as Out_ '''
+    model = make_palette(phase='test', sample_config={'sample_mode': 'ddim', 'sample_steps': 4, 'trajectory': trajectory})
+    model.test()
+    names = [name for results in model.writer.results for name in results['name']]
+    prefixes = ['GT_', 'Out_', 'Mask_'] + (['Process_'] if trajectory == 'snapshots' else [])
+    assert sorted(set(name.split('_')[0] + '_' for name in names)) == sorted(prefixes)
+    assert sorted(name for name in names if name.startswith('Out_')) == ['Out_{:02d}.png'.format(idx) for idx in range(4)]
+    if trajectory == 'snapshots':
+        ''' the initial y_t, the intermediate results and the output '''
+        results = model.writer.results[-1]['result']
+        assert results[1].shape[0] > 2 and torch.equal(results[1][-1], results[2])
+
+def test_gradient_accumulation_counts_whole_steps():
+    ''' 5 batches of 2 with accum_iter 2 are 3 optimizer steps of 4, 4 and 2 samples '''
+    model = make_palette(num_samples=10, train={'accum_iter': 2, 'log_iter': 4},
+        ema_scheduler={'ema_start': 0, 'ema_iter': 4, 'ema_decay': 0.9})
+    ''' DDP is simulated by recording which micro-batches run under no_sync '''
+    model.opt['distributed'] = True
+    model.get_network = lambda: model.netG
+    synced, in_no_sync = [], []
+    @contextlib.contextmanager
+    def no_sync():
+        in_no_sync.append(True)
+        yield
+        in_no_sync.pop()
+    model.netG.no_sync = no_sync
+    get_loss, optimizer_step, steps = model.get_loss, model.optG.step, []
+    def recorded_loss():
+        synced.append(not in_no_sync)
+        return get_loss()
+    def recorded_step(*args, **kwargs):
+        steps.append(model.iter)
+        return optimizer_step(*args, **kwargs)
+    model.get_loss, model.optG.step = recorded_loss, recorded_step
+
+    model.train_step()
+    assert synced == [False, True, False, True, True]
+    assert steps == [0, 4, 8] and model.iter == 10
+    ''' log_iter and ema_iter are crossed at 4 and 8 '''
+    assert model.writer.scalars.count('train/mse_loss') == 2
+    assert (model.EMA.num_updates, model.EMA.pending_steps) == (2, 1)
+
+@pytest.mark.parametrize('report_delta', [False, True])
+def test_static_quantization_calibrates_on_test_batches(report_delta):
+    model = make_palette(phase='test', sample_config={'sample_mode': 'ddim', 'sample_steps': 2},
+        quantize={'static_convs': True, 'calibration_batches': 1, 'report_delta': report_delta})
+    assert any(isinstance(m, nnq.Conv2d) for m in model.get_network().denoise_fn.modules())
+    model.test()
+    assert len(model.writer.results) == 2
+    assert ('test/mae_fp32' in model.test_metrics.result()) == report_delta
@@ -0,0 +1,51 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.ao.nn.quantized as nnq
+import torch.ao.nn.quantized.dynamic as nnqd
+
+from conftest import make_network
+from models.quantize import quantize_unet
+
+
+@pytest.fixture
+def unet():
+    ''' output layers are zero at initialisation, random weights give the UNet a real output '''
+    unet = make_network().denoise_fn
+    generator = torch.Generator().manual_seed(0)
+    with torch.no_grad():
+        for param in unet.parameters():
+            param.copy_(torch.randn(param.shape, generator=generator) * 0.05)
+    return unet
+
+def relative_error(output, expected):
+    return ((output - expected).norm() / expected.norm()).item()
+
+
+@pytest.mark.parametrize('static_convs', [False, True])
+def test_quantized_unet_matches_float(unet, inpaint_batch, static_convs):
+    y_0, y_cond, _ = inpaint_batch
+    x, gammas = torch.cat([y_cond, y_0], dim=1), torch.tensor([[0.3], [0.8]])
+    calibrated = []
+    def calibrate(prepared):
+        for gamma in [0.1, 0.5, 0.9]:
+            prepared(x, torch.full((2, 1), gamma))
+        calibrated.append(True)
+
+    state = {key: value.clone() for key, value in unet.state_dict().items()}
+    quantized = quantize_unet(unet, static_convs=static_convs, calibrate=calibrate)
+    assert calibrated == ([True] if static_convs else [])
+    ''' the float UNet is left untouched '''
+    assert all(torch.equal(value, state[key]) for key, value in unet.state_dict().items())
+    modules = list(quantized.modules())
+    assert any(isinstance(m, nnqd.Linear) for m in modules) and not any(type(m) is nn.Linear for m in modules)
+    convs = [m for m in modules if isinstance(m, (nn.Conv2d, nnq.Conv2d)) and m.kernel_size == (3, 3)]
+    assert all(isinstance(m, nnq.Conv2d) == static_convs for m in convs)
+    with torch.no_grad():
+        expected, output = unet(x, gammas), quantized(x, gammas)
+    assert output.shape == expected.shape and output.dtype == torch.float32
+    assert relative_error(output, expected) < 0.1
+
+def test_static_convs_need_calibration(unet):
+    with pytest.raises(AssertionError):
+        quantize_unet(unet, static_convs=True)
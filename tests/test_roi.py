@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from conftest import make_network
+from models.network import mask_bbox
+
+
+@pytest.mark.parametrize('box, margin, multiple, expected', [
+    ((8, 20, 10, 24), 0, 1, (8, 10, 12, 14)),
+    ((8, 20, 10, 24), 2, 4, (6, 8, 16, 20)),
+    ((8, 20, 10, 24), 0, 8, (8, 10, 16, 16)),
+    # grown past the border, the box is shifted back into the image
+    ((28, 31, 1, 3), 1, 8, (24, 0, 8, 8)),
+    # a multiple larger than the image is clamped to the image
+    ((2, 5, 2, 5), 0, 64, (0, 0, 32, 32)),
+])
+def test_mask_bbox_is_snapped_and_clamped(box, margin, multiple, expected):
+    top, bottom, left, right = box
+    mask = torch.zeros(1, 32, 32)
+    mask[:, top:bottom, left:right] = 1
+    bbox = mask_bbox(mask, margin, multiple)
+    assert bbox == expected
+    top, left, height, width = bbox
+    assert top >= 0 and left >= 0 and top + height <= 32 and left + width <= 32
+    assert mask[:, top:top+height, left:left+width].sum() == mask.sum()
+
+def test_mask_bbox_of_empty_mask():
+    assert mask_bbox(torch.zeros(1, 32, 32), 4, 8) is None
+
+@pytest.mark.parametrize('num_samples', [1, 2])
+def test_roi_restoration_keeps_known_pixels(inpaint_batch, num_samples):
+    ''' the second input has no masked pixels and is returned unchanged '''
+    y_0, y_cond, mask = inpaint_batch
+    mask = mask.clone()
+    mask[1] = 0
+    network = make_network({'sample_mode': 'ddim', 'roi_margin': 2})
+    output, visuals = network.restoration(y_cond, y_t=y_cond, y_0=y_0, mask=mask, sample_steps=4, num_samples=num_samples)
+    assert output.shape == (2*num_samples, 3, 32, 32)
+    y_0, mask = y_0.repeat_interleave(num_samples, dim=0), mask.repeat_interleave(num_samples, dim=0)
+    assert torch.equal(output * (1 - mask), y_0 * (1 - mask))
+    assert not torch.equal(output[0], y_0[0])
+    assert torch.equal(output[num_samples:], y_0[num_samples:])
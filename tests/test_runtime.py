@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import torch
+
+from conftest import make_network
+from export import export_unet, save_schedule
+from models.runtime import Sampler
+
+@pytest.fixture(scope='module')
+def exported(tmp_path_factory):
+    torch.manual_seed(0)
+    network = make_network()
+    output = str(tmp_path_factory.mktemp('export') / 'unet')
+    formats = ['torchscript']
+    try:
+        import onnxruntime, onnxscript
+        formats.append('onnx')
+    except ImportError:
+        pass
+    export_unet(network, output, formats=formats, image_size=32)
+    save_schedule(network, output, phase='test')
+    return network, output, formats
+
+@pytest.mark.parametrize('sample_mode', ['ddim', 'dpm_solver'])
+@pytest.mark.parametrize('model_format', ['pt', 'onnx'])
+def test_sampler_matches_restoration(exported, inpaint_batch, sample_mode, model_format):
+    network, output, formats = exported
+    if model_format == 'onnx' and 'onnx' not in formats:
+        pytest.skip('onnxruntime is not installed')
+    y_0, y_cond, mask = inpaint_batch
+    network.sample_mode, network.sample_steps = sample_mode, 10
+    expected, _ = network.restoration(y_cond, y_t=y_cond, y_0=y_0, mask=mask)
+
+    sampler = Sampler('{}.{}'.format(output, model_format), '{}_schedule.npz'.format(output), sample_mode=sample_mode, sample_steps=10)
+    result = sampler.restoration(y_cond.numpy(), y_t=y_cond.numpy(), y_0=y_0.numpy(), mask=mask.numpy())
+    np.testing.assert_allclose(result, expected.numpy(), atol=1e-4)
+
+def test_sampler_rejects_unknown_mode(exported):
+    _, output, _ = exported
+    with pytest.raises(NotImplementedError):
+        Sampler('{}.pt'.format(output), '{}_schedule.npz'.format(output), sample_mode='euler')
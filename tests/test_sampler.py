@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from conftest import make_network
+from models.runtime import space_timesteps
+
+
+class OracleUNet(nn.Module):
+    ''' predicts the exact noise of y_t for a known y_0, so every sampler has to land on y_0 '''
+    def __init__(self, y_0):
+        super().__init__()
+        self.register_buffer('y_0', y_0)
+
+    def forward(self, x, gammas):
+        y_t, gammas = x[:, -self.y_0.shape[1]:], gammas.view(-1, 1, 1, 1)
+        return (y_t - gammas.sqrt() * self.y_0) / (1 - gammas).sqrt()
+
+def oracle_network(y_0, sample_config):
+    network = make_network(sample_config)
+    network.denoise_fn = OracleUNet(y_0)
+    return network
+
+
+@pytest.mark.parametrize('sample_steps', [50, 10, 3])
+def test_ddim_oracle_recovers_y0(inpaint_batch, sample_steps):
+    y_0, y_cond, _ = inpaint_batch
+    network = oracle_network(y_0, {'sample_mode': 'ddim'})
+    output, _ = network.restoration(y_cond, sample_steps=sample_steps)
+    assert torch.allclose(output, y_0, atol=1e-4)
+
+def test_ddim_step_matches_closed_form(inpaint_batch):
+    ''' with eta 0 a DDIM step keeps the predicted noise: y_prev = sqrt(g_prev) * y_0_hat + sqrt(1 - g_prev) * noise '''
+    y_0, y_cond, _ = inpaint_batch
+    network = make_network({'sample_mode': 'ddim'})
+    y_t = torch.randn_like(y_0)
+    t, t_prev = torch.full((2,), 40), torch.full((2,), 20)
+    gamma_t, gamma_prev = network.gammas[40], network.gammas[20]
+    with torch.no_grad():
+        noise = network.denoise_fn(torch.cat([y_cond, y_t], dim=1), gamma_t.expand(2, 1))
+    y_0_hat = (y_t - (1 - gamma_t).sqrt() * noise) / gamma_t.sqrt()
+    expected = gamma_prev.sqrt() * y_0_hat + (1 - gamma_prev).sqrt() * noise
+    y_prev = network.ddim_sample(y_t, t, t_prev, clip_denoised=False, y_cond=y_cond)
+    assert torch.allclose(y_prev, expected, atol=1e-4)
+
+def test_ddim_eta_zero_is_deterministic(inpaint_batch):
+    y_0, y_cond, mask = inpaint_batch
+    network = make_network({'sample_mode': 'ddim'})
+    y_t = torch.randn_like(y_0)
+    first, _ = network.restoration(y_cond, y_t=y_t, y_0=y_0, mask=mask, sample_steps=5)
+    second, _ = network.restoration(y_cond, y_t=y_t, y_0=y_0, mask=mask, sample_steps=5)
+    assert torch.equal(first, second)
+    assert torch.equal(first * (1 - mask), y_0 * (1 - mask))
+
+
+@pytest.mark.parametrize('sample_steps', [20, 5, 2])
+def test_dpm_solver_oracle_recovers_y0(inpaint_batch, sample_steps):
+    y_0, y_cond, _ = inpaint_batch
+    network = oracle_network(y_0, {'sample_mode': 'dpm_solver'})
+    output, _ = network.restoration(y_cond, sample_steps=sample_steps)
+    assert torch.allclose(output, y_0, atol=1e-4)
+
+def test_dpm_solver_first_step_matches_ddim(inpaint_batch):
+    ''' without a previous data prediction DPM-Solver++ is first order, which is DDIM with eta 0 '''
+    y_0, y_cond, _ = inpaint_batch
+    network = make_network({'sample_mode': 'dpm_solver'})
+    y_t = torch.randn_like(y_0)
+    t, t_prev = torch.full((2,), 40), torch.full((2,), 20)
+    y_prev, _ = network.dpm_solver_sample(y_t, t, t_prev, y_cond=y_cond)
+    expected = network.ddim_sample(y_t, t, t_prev, y_cond=y_cond)
+    assert torch.allclose(y_prev, expected, atol=1e-4)
+
+
+def test_space_timesteps_are_nested():
+    assert space_timesteps(1000, 4).tolist() == [249, 499, 749, 999]
+    assert set(space_timesteps(1000, 4)) <= set(space_timesteps(1000, 8))
+    assert space_timesteps(50, 50).tolist() == list(range(50))
+
+@pytest.mark.parametrize('sample_steps', [50, 10, 3])
+def test_respaced_schedule_keeps_gammas(sample_steps):
+    network = make_network()
+    schedule = network.respace(sample_steps)
+    assert torch.allclose(schedule.gammas, network.gammas[schedule.timesteps], rtol=1e-6)
+    if sample_steps == network.num_timesteps:
+        for key in ['gammas', 'posterior_mean_coef1', 'posterior_mean_coef2', 'posterior_log_variance_clipped']:
+            assert torch.allclose(getattr(schedule, key), getattr(network, key), rtol=1e-5)
+
+def test_respaced_ddpm_oracle_recovers_y0(inpaint_batch):
+    y_0, y_cond, _ = inpaint_batch
+    network = oracle_network(y_0, {'sample_mode': 'ddpm', 'sample_steps': 10})
+    assert np.array_equal(network.sample_timesteps(10), np.arange(10)[::-1])
+    output, _ = network.restoration(y_cond)
+    assert torch.allclose(output, y_0, atol=1e-4)
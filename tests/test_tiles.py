@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from conftest import make_network
+from models.network import Tiles
+
+
+@pytest.mark.parametrize('shape, tile_size, overlap', [((2, 3, 40, 70), 32, 8), ((1, 3, 33, 50), 16, 4), ((1, 3, 5, 9), 4, 1)])
+def test_tile_weights_cover_every_pixel(shape, tile_size, overlap):
+    tiles = Tiles(shape, tile_size, overlap, multiple=4)
+    assert tiles.tile_h % 4 == 0 and tiles.tile_w % 4 == 0
+    assert (tiles.weights[..., :shape[2], :shape[3]] > 0).all()
+
+def test_single_tile_matches_untiled(inpaint_batch):
+    y_0, y_cond, _ = inpaint_batch
+    network = make_network()
+    tiles = Tiles(y_0.shape, 32, 8, multiple=network.downsample_factor)
+    assert len(tiles.tiles) == 2
+    noise_level = torch.tensor([[0.3], [0.8]])
+    with torch.no_grad():
+        expected = network.denoise_fn(torch.cat([y_cond, y_0], dim=1), noise_level)
+        assert torch.allclose(tiles.denoise(network.denoise_fn, y_cond, y_0, noise_level), expected, atol=1e-6)
+
+@pytest.mark.parametrize('height, width', [(40, 22), (36, 3)])
+def test_tiled_sampling_keeps_known_pixels(height, width):
+    ''' sides that are no multiple of the downsampling factor (4), down to one narrower than a single multiple '''
+    network = make_network({'sample_mode': 'ddim', 'tile_size': 16, 'tile_overlap': 4}, channel_mults=[1, 2, 2])
+    generator = torch.Generator().manual_seed(0)
+    y_0 = torch.rand(1, 3, height, width, generator=generator) * 2 - 1
+    mask = torch.zeros(1, 1, height, width)
+    mask[..., 10:30, 1:] = 1
+    y_cond = y_0*(1. - mask) + mask*torch.randn(1, 3, height, width, generator=generator)
+    output, _ = network.restoration(y_cond, y_t=y_cond, y_0=y_0, mask=mask, sample_steps=3)
+    assert output.shape == y_0.shape
+    assert torch.equal(output * (1 - mask), y_0 * (1 - mask))
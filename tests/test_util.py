@@ -0,0 +1,41 @@
+import datetime
+import os
+import pytest
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from core.util import rank_zero_first
+
+
+def build_file(rank, world_size, init_file, path, fail):
+    ''' GPU 0 writes path in rank_zero_first, the other GPUs read it, the timeout fails the test instead of hanging it '''
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=world_size, timeout=datetime.timedelta(seconds=30))
+    try:
+        with rank_zero_first():
+            if rank == 0:
+                if fail:
+                    raise ValueError('cannot build the file')
+                with open(path, 'w') as f:
+                    f.write('built')
+            with open(path) as f:
+                content = f.read()
+        assert not fail and content == 'built'
+    except ValueError:
+        assert fail and rank == 0
+    except RuntimeError as e:
+        assert fail and rank != 0 and 'cannot build the file' in str(e)
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_rank_zero_first(tmp_path, fail):
+    ''' an error of GPU 0 reaches the other GPUs instead of leaving them waiting '''
+    mp.spawn(build_file, args=(2, str(tmp_path / 'init'), str(tmp_path / 'file'), fail), nprocs=2)
+    assert os.path.exists(tmp_path / 'file') != fail
+
+def test_rank_zero_first_without_distributed():
+    ran = []
+    with rank_zero_first():
+        ran.append(True)
+    assert ran == [True]